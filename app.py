@@ -1,55 +1,119 @@
 from flask import Flask
 from flask import request
+from flask import abort
 
 import hashlib
+import hmac
 import json
+import csv
+import io
+import os
 
-from datetime import time, datetime, timedelta
-from threading import Thread, Event
-from time import sleep
+from datetime import datetime
+from time import monotonic
 
-from classes import Task, Calendar
+from classes import Task, default_task_length, default_min_segment
+from tenants import TenantRegistry, tenant_configs, default_tenant
 
 from tzlocal import get_localzone
 
-closed = Event()
+class CachedFile:
+    """
+    A file which is read once and kept in memory, so serving a request doesn't touch the disk.
 
-def read_config():
-    with open("config.json", "r") as f:
-        return json.loads(f.read())
+    It is only read again if its modification time has changed (looked at no more than once every check_interval seconds), or
+    after reload() is called, which happens on SIGHUP.
+    """
+    def __init__(self, path, parse=None, check_interval=5):
+        self.path = path
+        self.parse = parse
+        self.check_interval = check_interval
+
+        self.value = None
+        self.mtime = None
+        self.checked = None # monotonic time of the last mtime check
+    
+    def get(self):
+        now = monotonic()
 
-def parse_time(string):
-    index = string.find(":")
+        if self.value is None or now - self.checked >= self.check_interval:
+            self.checked = now
 
-    hour = int(string[:index])
-    minute = int(string[index+1:])
+            mtime = os.stat(self.path).st_mtime_ns
+            if self.value is None or mtime != self.mtime:
+                with open(self.path, "r") as f:
+                    text = f.read()
+                
+                self.value = text if self.parse is None else self.parse(text)
+                self.mtime = mtime
+        
+        return self.value
+    
+    def reload(self):
+        self.value = None
 
-    return time(hour=hour,minute=minute)
+class PasswordCheck:
+    """
+    The salt and expected digest from a tenant's config, decoded once rather than on every request. source is the config.json it
+    came from.
+    """
+    def __init__(self, config, source):
+        self.source = source
+        self.salt = config["salt"].encode("utf-8")
+        self.digest = bytes.fromhex(config["password_hash"])
+    
+    def check(self, password):
+        hash_obj = hashlib.sha512()
+        hash_obj.update(password.encode("utf-8"))
+        hash_obj.update(self.salt)
 
-data = read_config()
-log_on = parse_time(data["log_on"])
-log_off = parse_time(data["log_off"])
+        # constant time, so how long this takes doesn't give away how much of the hash matched
+        return hmac.compare_digest(hash_obj.digest(), self.digest)
 
-calendar = Calendar(log_on, log_off)
-calendar.start()
+config_file = CachedFile("config.json", json.loads)
+page_file = CachedFile("./input.html")
 
-refresh_rate = 5
+password_checks = {} # tenant name: PasswordCheck
+
+def read_config():
+    return config_file.get()
 
-def refresh():
-    while True:
-        if closed.is_set():
-            break
-        sleep(refresh_rate)
-        calendar.reload_tasks() # refresh the calendar every minute, checking for new events which would interrupt the current tasks
+# every tenant's calendar, none of them talk to google until the refresh pool starts
+registry = TenantRegistry(read_config())
 
 app = Flask("Calendar")
 
+def find_tenant(name):
+    """
+    The tenant a request is for, the default one if the url doesn't say. 404s if there isn't one.
+    """
+    tenant = registry.get(default_tenant if name is None else name)
+
+    if tenant is None:
+        abort(404)
+
+    return tenant
+
+def tenant_route(rule, **options):
+    """
+    Like app.route, but the view is also served under /t/<tenant>, and is given the tenant (None for the route without the prefix).
+    """
+    def decorator(view):
+        app.route(rule, defaults={"tenant": None}, **options)(view)
+        app.route(f"/t/<tenant>{rule}", **options)(view)
+
+        return view
+
+    return decorator
+
 @app.route("/")
 def hello_world():
     return "<p>Hello, world!</p>"
 
-@app.route("/upload",methods=["POST"])
-def receive_event():
+@tenant_route("/upload",methods=["POST"])
+def receive_event(tenant):
+    tenant = find_tenant(tenant)
+
     html_args = request.form
 
     name = html_args["name"]
@@ -58,34 +122,201 @@ def receive_event():
     due = html_args["due"]
     password = html_args["password"]
 
-    # convert the due to a datetime object
-    due = datetime.fromisoformat(due).replace(tzinfo=get_localzone())
+    split = "split" in html_args # checkboxes are only sent when they're ticked
+    min_segment = int(html_args.get("min_segment") or default_min_segment)
 
-    config = read_config()
+    try:
+        check_length(required_time)
+        check_min_segment(min_segment)
+    except ValueError as e:
+        return f"<p>{e}</p>", 400
 
-    hash_obj = hashlib.sha512()
-    hash_obj.update(password.encode("utf-8"))
-    hash_obj.update(config["salt"].encode("utf-8"))
+    # convert the due to a datetime object
+    due = datetime.fromisoformat(due).replace(tzinfo=get_localzone())
 
-    if hash_obj.hexdigest() == config["password_hash"]:
+    if check_password(tenant, password):
         # now we can create the task
-        calendar.insert_task(Task(name, desc=desc, minutes=required_time, due=due))
+        # through tasks_pending, which is saved straight away and merged into the queue by the refresh thread
+        tenant.calendar.add_tasks([Task(name, desc=desc, minutes=required_time, due=due, split=split, min_segment=min_segment)])
+        registry.wake(tenant)
         return "<p>Inserted the task</p>", 200
     else:
         return "<p>Unauthorized request</p>", 403
 
-@app.route("/tasks")
-def serve_page():
-    with open("./input.html") as f:
-        return f.read()
+@tenant_route("/upload/bulk",methods=["POST"])
+def receive_events(tenant):
+    """
+    Takes a whole batch of tasks as JSON lines, or CSV with a header row if the content type is text/csv. Each task has a name, and
+    optionally desc, length (or time) in minutes, due, split and min_segment. The password goes in the X-Password header.
+
+    The batch is checked once, and either all of it goes in or none of it does.
+    """
+    tenant = find_tenant(tenant)
+
+    if not check_password(tenant, request.headers.get("X-Password", "")):
+        return "<p>Unauthorized request</p>", 403
+
+    try:
+        tasks = read_tasks()
+    except ValueError as e:
+        return f"<p>{e}</p>", 400
+
+    # one merge, one save and one reschedule for the whole batch
+    tenant.calendar.add_tasks(tasks)
+    registry.wake(tenant)
+
+    return f"<p>Inserted {len(tasks)} tasks</p>", 200
+
+@tenant_route("/schedule")
+def serve_schedule(tenant):
+    """
+    The plan from the last refresh as JSON, the same one that was uploaded to google. The password goes in the X-Password header.
+
+    Send the ETag back in If-None-Match to get a 304 if the plan hasn't changed since, so dashboards can poll it cheaply.
+    """
+    tenant = find_tenant(tenant)
+
+    if not check_password(tenant, request.headers.get("X-Password", "")):
+        return "<p>Unauthorized request</p>", 403
+
+    body, etag = tenant.calendar.schedule()
+
+    response = app.response_class(body, mimetype="application/json")
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "no-cache" # always check back, it's only a 304 if nothing changed
+
+    return response.make_conditional(request.environ)
+
+@tenant_route("/schedule/preview",methods=["POST"])
+def preview_schedule(tenant):
+    """
+    What the plan would be with the tasks in the body added, in the same formats /upload/bulk takes, without adding them. It's
+    worked out against the events from the last refresh, and nothing is sent to google.
+    """
+    tenant = find_tenant(tenant)
+
+    if not check_password(tenant, request.headers.get("X-Password", "")):
+        return "<p>Unauthorized request</p>", 403
+
+    try:
+        tasks = read_tasks()
+    except ValueError as e:
+        return f"<p>{e}</p>", 400
+
+    plan = tenant.calendar.preview(tasks)
+    plan["added"] = [task.uid for task in tasks]
+
+    return plan, 200
+
+def read_tasks():
+    """
+    The tasks in the request body, as JSON lines, or CSV with a header row if the content type is text/csv. Raises ValueError if
+    any of them can't be read.
+    """
+    text = request.get_data(as_text=True)
+
+    if request.mimetype == "text/csv":
+        rows = csv.DictReader(io.StringIO(text))
+    else:
+        rows = (json.loads(line) for line in text.splitlines() if line.strip() != "")
+
+    tasks = []
+
+    try:
+        for row in rows:
+            tasks.append(parse_task(row))
+    except (ValueError, KeyError, TypeError) as e:
+        raise ValueError(f"Couldn't read task {len(tasks) + 1}: {e}")
+
+    return tasks
+
+def check_password(tenant, password):
+    config = read_config()
+    password_check = password_checks.get(tenant.name)
+
+    if password_check is None or password_check.source is not config:
+        # config.json has been read again since the last check
+        tenant_config = tenant_configs(config).get(tenant.name)
+
+        if tenant_config is None:
+            return False # taken out of config.json since the server started
+
+        password_check = password_checks[tenant.name] = PasswordCheck(tenant_config, config)
+
+    return password_check.check(password)
+
+def parse_task(row):
+    """
+    Makes a Task out of a dict with the same fields /upload takes, or the ones Task.obj() gives.
+    """
+    name = row["name"]
+    if not name:
+        raise ValueError("a task needs a name")
 
-calendar_loop = Thread(target=refresh)
-calendar_loop.start()
+    minutes = given(row, "length", "time", default=default_task_length)
+
+    due = row.get("due") or None
+    if due is not None:
+        due = datetime.fromisoformat(due)
+
+        if due.tzinfo is None:
+            due = due.replace(tzinfo=get_localzone())
+
+    split = row.get("split") in (True, "true", "True", "yes", "on", "1")
+    min_segment = int(given(row, "min_segment", default=default_min_segment))
+
+    minutes = int(minutes)
+    check_length(minutes)
+    check_min_segment(min_segment)
+
+    return Task(name, desc=row.get("desc") or "", minutes=minutes, due=due, split=split, min_segment=min_segment)
+
+def given(row, *fields, default=None):
+    """
+    The first of fields which row has a value for. Empty strings (a blank CSV column) don't count, but 0 does, so it can be turned away.
+    """
+    for field in fields:
+        if row.get(field) not in (None, ""):
+            return row[field]
+
+    return default
+
+def check_length(minutes):
+    # a task of no time (or less) would give time back to the gap it's placed in, and events would end up on top of each other
+    if minutes < 1:
+        raise ValueError(f"a task has to take at least a minute, not {minutes}")
+
+def check_min_segment(min_segment):
+    # plans are laid out on a 15 minute grid, anything shorter isn't a piece worth having
+    if min_segment < 15:
+        raise ValueError(f"min_segment has to be at least 15 minutes, not {min_segment}")
+
+@tenant_route("/tasks")
+def serve_page(tenant):
+    find_tenant(tenant)
+
+    return page_file.get()
+
+@tenant_route("/metrics")
+def serve_metrics(tenant):
+    calendar = find_tenant(tenant).calendar
+    calendar.update_gauges()
+
+    return calendar.metrics.render(), 200, {"Content-Type": "text/plain; version=0.0.4"}
+
+registry.start()
 
 import sys
 import signal
 
 def handler(signal, frame):
-    closed.set()
+    registry.close()
     sys.exit(0)
 signal.signal(signal.SIGINT, handler)
+
+def reload_files(signal, frame):
+    config_file.reload()
+    page_file.reload()
+
+if hasattr(signal, "SIGHUP"):
+    signal.signal(signal.SIGHUP, reload_files) # kill -HUP to pick up changes to config.json or input.html straight away
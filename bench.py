@@ -0,0 +1,178 @@
+"""
+Measures how a reload scales, against fake_calendar.py instead of Google.
+
+For every combination of the sizes given it sets up a fresh Calendar with that many tasks, external events and read calendars, and
+a planning horizon of that many days, then runs reload_tasks twice: once from nothing (everything gets uploaded) and once more
+straight after (nothing should need to change). Each phase of the reload reports its wall time, the API calls it made and its peak
+memory.
+
+    python bench.py
+    python bench.py --tasks 100,1000 --events 1000 --calendars 1,4 --horizon 30 --latency 0.05
+"""
+
+import argparse
+import itertools
+import json
+import os
+import random
+import sys
+import tempfile
+import tracemalloc
+from datetime import datetime, time, timedelta
+from time import perf_counter
+
+from gcsa.event import Event
+
+from fake_calendar import FakeGoogleCalendar
+
+# the parts of reload_tasks which get timed, in the order they run
+phases = ["merge_pending", "check_event_updates", "update_events", "organise_calendar", "reconcile", "apply_mutations", "save_events"]
+
+class Recorder:
+    def __init__(self, fakes, memory=True):
+        self.fakes = fakes
+        self.memory = memory
+        self.results = {} # phase: [seconds, calls, peak bytes]
+
+    def api_calls(self):
+        return sum(sum(fake.calls.values()) for fake in self.fakes)
+
+    def wrap(self, calendar, name):
+        method = getattr(calendar, name)
+
+        def timed(*args, **kwargs):
+            calls = self.api_calls()
+            if self.memory:
+                tracemalloc.reset_peak()
+                baseline = tracemalloc.get_traced_memory()[0]
+
+            start = perf_counter()
+            result = method(*args, **kwargs)
+            elapsed = perf_counter() - start
+
+            peak = tracemalloc.get_traced_memory()[1] - baseline if self.memory else 0
+
+            # phases can run more than once a reload (e.g. when the horizon is pushed out), add them up
+            totals = self.results.setdefault(name, [0, 0, 0])
+            totals[0] += elapsed
+            totals[1] += self.api_calls() - calls
+            totals[2] = max(totals[2], peak)
+
+            return result
+
+        setattr(calendar, name, timed)
+
+class NoNotify:
+    def send(self, content):
+        pass
+
+def make_events(calendar_id, count, days, rng):
+    """
+    count events of 30 minutes to 2 hours spread over the next days days, during the day.
+    """
+    now = datetime.now().astimezone()
+    events = []
+
+    for i in range(count):
+        start = now.replace(hour=8, minute=0, second=0, microsecond=0) + timedelta(days=rng.randrange(max(days, 1)), minutes=15 * rng.randrange(48))
+        events.append(Event(f"event {i}", start=start, end=start + timedelta(minutes=rng.choice([30, 60, 90, 120])), event_id=f"{calendar_id}-{i}"))
+
+    return events
+
+def run(classes, settings, tasks, events, calendars, horizon, latency, memory, seed=0):
+    rng = random.Random(seed)
+
+    settings = classes.Settings(dict(settings, horizon_days=horizon, read_calendars=[f"read{i}@fake" for i in range(calendars)]))
+
+    write = FakeGoogleCalendar(settings.write_calendar, latency)
+    fakes = {settings.write_calendar: write}
+
+    for calendar_id in settings.read_calendars:
+        fakes[calendar_id] = FakeGoogleCalendar(calendar_id, latency, make_events(calendar_id, events // calendars, horizon, rng))
+
+    for name in os.listdir("."):
+        if name.startswith("events.db"):
+            os.remove(name) # a fresh store each run
+
+    calendar = classes.Calendar(time(hour=8), time(hour=22), notify_run_client=NoNotify(), link_factory=lambda calendar_id: fakes[calendar_id], settings=settings)
+
+    calendar.add_tasks([classes.Task(f"task {i}", minutes=rng.choice([15, 30, 60, 90])) for i in range(tasks)])
+
+    rows = []
+
+    for label in ["cold", "warm"]:
+        recorder = Recorder(list(fakes.values()), memory)
+        for phase in phases:
+            recorder.wrap(calendar, phase)
+
+        calls = recorder.api_calls()
+        start = perf_counter()
+        calendar.reload_tasks()
+        total = perf_counter() - start
+        calls = recorder.api_calls() - calls
+
+        for phase in phases:
+            delattr(calendar, phase) # back to the plain methods
+
+        rows.append((label, total, calls, recorder.results))
+
+    calendar.executor.pool.shutdown()
+    calendar.fetch_pool.shutdown()
+    if calendar.optimise_pool is not None:
+        calendar.optimise_pool.shutdown()
+    calendar.store.close()
+
+    return rows
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark reload_tasks against a fake Google Calendar.")
+    parser.add_argument("--tasks", default="10,100,500", help="comma separated numbers of tasks")
+    parser.add_argument("--events", default="100,1000", help="comma separated numbers of external events, split between the read calendars")
+    parser.add_argument("--calendars", default="1,4", help="comma separated numbers of read calendars")
+    parser.add_argument("--horizon", default="30", help="comma separated planning horizons in days")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds every fake API call takes")
+    parser.add_argument("--api-rate", type=float, default=10 ** 6, help="requests a second the client lets through, unlimited by default")
+    parser.add_argument("--no-memory", action="store_true", help="don't trace memory, it slows everything else down")
+    parser.add_argument("--json", action="store_true", help="print one JSON object per run instead of a table")
+    args = parser.parse_args()
+
+    numbers = lambda text: [int(x) for x in text.split(",")]
+
+    # the task store goes in the working directory, so give it one of its own
+    here = os.path.dirname(os.path.abspath(__file__))
+    os.chdir(tempfile.mkdtemp(prefix="calendar-bench-"))
+
+    settings = {
+        "write_calendar": "write@fake",
+        "service_account_file_name": "",
+        "notify_run_url": "",
+        "api_rate": args.api_rate,
+        "api_burst": max(1, args.api_rate),
+    }
+
+    sys.path.insert(0, here)
+    import classes
+
+    memory = not args.no_memory
+    if memory:
+        tracemalloc.start()
+
+    for tasks, events, calendars, horizon in itertools.product(numbers(args.tasks), numbers(args.events), numbers(args.calendars), numbers(args.horizon)):
+        for label, total, calls, results in run(classes, settings, tasks, events, calendars, horizon, args.latency, memory):
+            if args.json:
+                print(json.dumps({
+                    "tasks": tasks, "events": events, "calendars": calendars, "horizon": horizon, "run": label, "seconds": total, "calls": calls,
+                    "phases": {phase: {"seconds": seconds, "calls": calls, "peak_bytes": peak} for phase, (seconds, calls, peak) in results.items()},
+                }))
+                continue
+
+            print(f"tasks={tasks} events={events} calendars={calendars} horizon={horizon}d {label}: {total * 1000:.1f}ms, {calls} calls")
+            for phase in phases:
+                if phase not in results:
+                    continue
+
+                seconds, calls, peak = results[phase]
+                print(f"    {phase:<20} {seconds * 1000:9.1f}ms {calls:6} calls {peak / 1024:9.1f}KiB")
+
+if __name__ == "__main__":
+    main()
@@ -1,58 +1,108 @@
 from enum import Enum
 import json
-
-import requests
+import heapq
+from bisect import insort
 
 from copy import copy # already shallowcopy
-
-from google.oauth2 import service_account
+from uuid import uuid4
 
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from time import sleep
+import hashlib
 
-from datetime import datetime, timedelta, time
+from datetime import datetime, timedelta
 from tzlocal import get_localzone
 
 from gcsa.event import Event
-from gcsa.google_calendar import GoogleCalendar
-from gcsa.acl import AccessControlRule, ACLRole, ACLScopeType
+# gcsa.google_calendar and google.oauth2 take most of a second to import, they're imported when the first link is made instead
 
-# TODO: organise imports
+from googleapiclient.errors import HttpError
 
-config = None
-write_calendar = "" # simply a working email which is organised by oauth
-read_calendars = []
+from store import TaskStore
+from metrics import Metrics
+from notify import NotifyRun, Notifier
+from quota import TokenBucket, ReadCache, retry_delay
+import optimiser
+from scheduling import IntervalIndex, GapPool, PlanMemo, window_length, free_gaps, infeasible_tasks, to_minutes, from_minutes, minute
 
-with open("config.json", "r") as f:
-    config = json.loads(f.read())
-    write_calendar = config["write_calendar"]
-    read_calendars = config["read_calendars"]
+# TODO: organise imports
 
 tag = "#auto"
 local_timezone = get_localzone()
 
 default_task_length = 30 # for me, when i think of something i might want to do it's research that thing and 30 minutes should be fine
+default_min_segment = 30 # the shortest piece a split task gets cut into, in minutes
 notify_before_warning = 5 # 5 minutes before, remind you to change the colour
 
+# what every setting is when config.json doesn't say. write_calendar (simply a working email which is organised by oauth),
+# service_account_file_name and notify_run_url have to be given
+defaults = {
+    "read_calendars": [],
+
+    "incremental_sync": True, # set to false in config.json to download every read calendar in full each refresh
+
+    "horizon_days": 30, # how far ahead events are fetched, this grows on its own if the plan runs past it
+    "mutation_workers": 8, # how many creates/updates/deletes are sent to google at once
+    "log_ticks": False, # print a line of json with the timings after every reload
+
+    # google's default quota is 600 requests a minute, stay a bit under it
+    "api_rate": 8, # requests a second, on average
+    "api_burst": 20,
+    "api_retries": 5, # for rate limits and server errors
+    "api_backoff": 0.5, # seconds before the first retry, doubling every time after
+    "api_cache_ttl": 2, # seconds reads are cached for, 0 turns it off
+
+    # when the plan has late tasks, search for a better layout in worker processes (see optimiser.py)
+    "optimise": False,
+    "optimise_workers": 2,
+    "optimise_budget": 1.0, # seconds each reload can spend on it
+    "max_log_off_extension": 120, # minutes log_off can be pushed back by when you're swamped
+
+    "notify_timeout": 5, # seconds before giving up on a notify.run request
+    "notify_retries": 3,
+}
+
+class Settings:
+    """
+    The config of one calendar, e.g. settings.horizon_days, with anything the dict it's made from leaves out taken from defaults.
+    """
+    def __init__(self, values):
+        self.__dict__.update(defaults)
+        self.__dict__.update(values)
+
+def load_settings(path="config.json"):
+    with open(path, "r") as f:
+        return Settings(json.loads(f.read()))
+
 # rewrite _get_default_credentials_path to allow for the import of service account credentials while not tampering with the library
 
-def get_service_account_file():
+def get_service_account_file(file_name):
     home_dir = os.path.expanduser("~")
     credential_dir = os.path.join(home_dir, ".credentials")
     
     if not os.path.exists(credential_dir):
         raise FileNotFoundError(f'Default credentials directory "{credential_dir}" does not exist.')
     
-    credential_path = os.path.join(credential_dir, config["service_account_file_name"])
+    credential_path = os.path.join(credential_dir, file_name)
 
     return credential_path
 
-def load_service_account_credentials():
-    SERVICE_ACCOUNT_FILE = get_service_account_file()
+credentials_cache = {} # path: credentials, every calendar using the same key file shares them
+credentials_lock = threading.Lock()
+
+def load_service_account_credentials(file_name):
+    from google.oauth2 import service_account
 
-    SCOPES = ["https://www.googleapis.com/auth/calendar"]
-    token = service_account.Credentials.from_service_account_file(SERVICE_ACCOUNT_FILE, scopes=SCOPES)
+    SERVICE_ACCOUNT_FILE = get_service_account_file(file_name)
 
-    return token
+    with credentials_lock:
+        if SERVICE_ACCOUNT_FILE not in credentials_cache:
+            SCOPES = ["https://www.googleapis.com/auth/calendar"]
+            credentials_cache[SERVICE_ACCOUNT_FILE] = service_account.Credentials.from_service_account_file(SERVICE_ACCOUNT_FILE, scopes=SCOPES)
+
+        return credentials_cache[SERVICE_ACCOUNT_FILE]
 
 class GCColour(Enum):
     TOMATO = 11
@@ -67,33 +117,279 @@ class GCColour(Enum):
     GRAPE = 3
     GRAPHITE = 8
 
-def times_intersect(x1,x2,y1,y2):
-    if x2 == y1 or y2 == x1:
-        return False
+class MeteredLink:
+    """
+    Wraps a GoogleCalendar so every call made through it goes through the quota: it waits for a token from the shared TokenBucket,
+    is counted by operation (along with the ones which failed, were retried or had to wait) in a Metrics, and is retried with backoff
+    when google says to slow down or has a server error.
+
+    Reads are kept in a ReadCache shared by every link to the same calendar for a few seconds, and any write clears it.
+
+    The GoogleCalendar itself is only made (by calling factory) the first time it's needed.
+    """
+    operations = ["get_events", "get_event", "add_event", "update_event", "delete_event"]
+    reads = ["get_events", "get_event"]
+
+    def __init__(self, factory, metrics, bucket, cache, retries=5, backoff=0.5):
+        self.factory = factory
+        self.client = None
+        self.lock = threading.Lock()
+
+        self.metrics = metrics
+        self.bucket = bucket
+        self.cache = cache
+        self.retries = retries
+        self.backoff = backoff
+    
+    @property
+    def link(self):
+        if self.client is None:
+            with self.lock:
+                if self.client is None:
+                    self.client = self.factory()
+        
+        return self.client
     
-    return x2 >= y1 and y2 >= x1
+    def __getattr__(self, name):
+        attr = getattr(self.link, name)
+
+        if name not in self.operations:
+            return attr
+        
+        if name in self.reads:
+            def cached(*args, **kwargs):
+                return self.read(name, lambda: list(attr(*args, **kwargs)) if name == "get_events" else attr(*args, **kwargs), (name, args, tuple(sorted(kwargs.items()))))
 
-def contextualise(time, date):
+            return cached
+        
+        def written(*args, **kwargs):
+            try:
+                return self.count(name, attr, *args, **kwargs)
+            finally:
+                self.cache.clear() # even a failed write might have gone through
+        
+        return written
+    
+    def read(self, operation, function, key):
+        """
+        A read through the cache. Events are copied on the way out, the ones in the cache must stay as google sent them.
+        """
+        result = self.cache.get(key)
+
+        if result is ReadCache.missing:
+            result = self.count(operation, function)
+            self.cache.put(key, result)
+        else:
+            self.metrics.inc("api_cache_hits_total", operation=operation)
+        
+        if isinstance(result, list):
+            return [copy(event) for event in result]
+
+        return copy(result)
+    
+    def count(self, operation, function, *args, **kwargs):
+        for attempt in range(self.retries + 1):
+            waited = self.bucket.acquire()
+            if waited > 0:
+                self.metrics.inc("api_throttled_seconds_total", waited, operation=operation)
+
+            self.metrics.inc("api_calls_total", operation=operation)
+
+            try:
+                return function(*args, **kwargs)
+            except Exception as e:
+                self.metrics.inc("api_errors_total", operation=operation)
+
+                delay = retry_delay(e, attempt, self.backoff)
+                if delay is None or attempt == self.retries:
+                    raise
+                
+                self.metrics.inc("api_retries_total", operation=operation)
+                sleep(delay)
+    
+    def __iter__(self):
+        return iter(self.read("get_events", lambda: list(self.link), ("get_events",)))
+    
+    def list_raw(self, **kwargs):
+        """
+        A raw events.list request, for the parameters gcsa doesn't pass through (sync tokens, updatedMin). Returns one page as JSON.
+
+        These aren't cached, they're how changes get noticed.
+        """
+        return self.count("list", lambda: self.link.service.events().list(**kwargs).execute())
+
+class EventStore:
     """
-    Adds a date to a time, allowing for the time to be compared against the global timeline
+    A local copy of the events on one read calendar.
+
+    The first sync downloads every upcoming event and keeps the sync token Google hands back. Every sync after that only asks
+    for what changed since the token, and applies the inserts, updates and cancellations to the local copy.
     """
-    return date.replace(hour=time.hour,minute=time.minute,second=time.second)
+    def __init__(self, calendar_id, link):
+        self.calendar_id = calendar_id
+        self.link = link # a MeteredLink, anything with list_raw() will do
+
+        self.events = {} # event_id: Tuple(start, end) in epoch minutes, only events which block out time and aren't managed by this app
+        self.sync_token = None
+        self.time_max = None # events starting after this aren't kept
+
+        self.sorted_events = None # cached result of upcoming(), thrown away whenever self.events changes
+        self.dirty = False # whether it's changed since it was last saved
+    
+    def sync(self, time_max):
+        """
+        Brings the local copy up to date with Google for everything from now until time_max. Falls back to a full download if there is
+        no sync token, it has expired or time_max has moved.
+
+        Returns True if anything on the calendar changed.
+        """
+        if self.sync_token is None or time_max != self.time_max:
+            self.full_sync(time_max)
+            return True
+        
+        try:
+            changes = self.fetch(syncToken=self.sync_token)
+        except HttpError as e:
+            if e.resp.status != 410:
+                raise
+            
+            # 410 Gone means google has invalidated the token, the only way back is to start again
+            self.full_sync(time_max)
+            return True
+        
+        self.prune()
+
+        return changes > 0
+    
+    def full_sync(self, time_max):
+        self.events = {}
+        self.sync_token = None
+        self.sorted_events = None
+        self.time_max = time_max
+        self.dirty = True
+
+        now = datetime.now(local_timezone)
+
+        self.fetch(timeMin=now.isoformat(), timeMax=time_max.isoformat())
+    
+    def prune(self):
+        """
+        Drops events which have finished, so the local copy only grows with the window and not with the calendar's history.
+        """
+        now = to_minutes(datetime.now(local_timezone))
+
+        finished = [event_id for event_id, (start, end) in self.events.items() if end <= now]
 
-class NotifyRun:
-    def __init__(self,url):
-        self.url = url
+        for event_id in finished:
+            self.events.pop(event_id)
+        
+        if len(finished) > 0:
+            self.sorted_events = None
+            self.dirty = True
     
-    def send(self,content):
-        r=requests.post(url=self.url,data=content)
+    def fetch(self, **kwargs):
+        """
+        Runs an events.list query through every page and applies the results. Returns how many items came back.
+        """
+        page_token = None
+        count = 0
+
+        while True:
+            response = self.link.list_raw(calendarId=self.calendar_id, singleEvents=True, pageToken=page_token, **kwargs)
+
+            for item in response.get("items", []):
+                self.apply(item)
+                count += 1
+            
+            page_token = response.get("nextPageToken")
+            if not page_token:
+                break
+        
+        # only the last page carries the token. if google doesn't send one, the next sync will be a full one
+        if response.get("nextSyncToken") != self.sync_token:
+            self.sync_token = response.get("nextSyncToken")
+            self.dirty = True
+
+        return count
+    
+    def apply(self, item):
+        """
+        Applies a single event resource from the events.list response onto the local copy.
+        """
+        self.sorted_events = None
+        self.dirty = True
+
+        if item.get("status") == "cancelled":
+            # cancelled entries may only carry an id, so don't try to parse them
+            self.events.pop(item["id"], None)
+            return
+
+        # only the start and end are kept, a whole gcsa Event for every event on every calendar is a lot of memory for two numbers
+        start = item.get("start", {}).get("dateTime")
+        end = item.get("end", {}).get("dateTime")
+
+        if start is None or end is None or item.get("transparency") == "transparent":
+            # all day events (birthdays, holidays) and events marked as free don't block out any time
+            self.events.pop(item["id"], None)
+            return
+
+        if item.get("description", "").endswith(tag):
+            self.events.pop(item["id"], None)
+            return
+
+        start = datetime.fromisoformat(start)
+
+        # incremental syncs report changes anywhere on the calendar, only keep what's inside the window
+        if self.time_max is not None and start >= self.time_max:
+            self.events.pop(item["id"], None)
+            return
+        
+        self.events[item["id"]] = (to_minutes(start), to_minutes(datetime.fromisoformat(end), up=True))
+    
+    def snapshot(self):
+        return {
+            "sync_token": self.sync_token,
+            "time_max": self.time_max.isoformat() if self.time_max is not None else None,
+            "events": self.events,
+        }
+    
+    def restore(self, snapshot):
+        time_max = snapshot["time_max"]
+
+        self.sync_token = snapshot["sync_token"]
+        self.time_max = datetime.fromisoformat(time_max) if time_max is not None else None
+        self.events = {event_id: tuple(event) for event_id, event in snapshot["events"].items()}
+        self.sorted_events = None
+        self.dirty = False
+
+    def upcoming(self):
+        """
+        Returns the events in the local copy which haven't finished yet as Tuple(start, end) in epoch minutes, sorted by start time.
+        """
+        if self.sorted_events is None:
+            self.sorted_events = sorted(self.events.values())
+        
+        now = to_minutes(datetime.now(local_timezone))
+
+        return [event for event in self.sorted_events if event[1] > now]
 
 class Task:
-    def __init__(self, name, desc="", minutes=60, due=None):
+    __slots__ = ("name", "desc", "length", "due", "split", "min_segment", "uid") # there can be thousands of these, keep them small
+
+    def __init__(self, name, desc="", minutes=60, due=None, split=False, min_segment=default_min_segment, uid=None):
         # time will be in minutes, just an integer
         self.length = timedelta(minutes=minutes)
         self.due = due # this is an optional parameter, if it doesn't exist then there is no time limit for this task
         self.name = name
         self.desc = desc
 
+        # if split is on, the task can be cut up into segments of at least min_segment minutes to fill smaller gaps
+        self.split = split
+        self.min_segment = timedelta(minutes=min_segment)
+
+        # a split task has an event per segment, this is how they find their way back to the same task after a restart
+        self.uid = uid if uid is not None else uuid4().hex
+
 # TODO: TASK TO DO AFTER A CERTAIN DATE
     
     def __repr__(self):
@@ -102,7 +398,8 @@ class Task:
     def obj(self):
         d = {
             "name": self.name,
-            "desc": self.desc
+            "desc": self.desc,
+            "id": self.uid
         }
 
         mins = self.length.total_seconds() / 60
@@ -111,6 +408,10 @@ class Task:
         if self.due is not None:
             d["due"] = self.due.isoformat()
         
+        if self.split:
+            d["split"] = True
+            d["min_segment"] = round(self.min_segment.total_seconds() / 60)
+        
         return d
     
     def json(self):
@@ -118,18 +419,14 @@ class Task:
     
     @classmethod
     def from_json(self, js):
-        d = json.loads(js)
-        due = d.get("due")
-        if due is not None:
-            due = datetime.fromisoformat(due)
-        return self(d["name"], d["desc"], d["length"], due)
+        return self.from_obj(json.loads(js))
 
     @classmethod
     def from_obj(self, d):
         due = d.get("due")
         if due is not None:
             due = datetime.fromisoformat(due)
-        return self(d["name"], d["desc"], d["length"], due)
+        return self(d["name"], d["desc"], d["length"], due, d.get("split", False), d.get("min_segment", default_min_segment), d.get("id"))
         
 
     def __eq__(self,other):
@@ -138,51 +435,428 @@ class Task:
 
         return False
 
+class Segment:
+    """
+    One piece of a split task, which gets its own event. It looks like a Task (name, desc, length) as far as uploading goes, and
+    task is the Task it belongs to.
+    """
+    __slots__ = ("task", "length")
+
+    def __init__(self, task, length):
+        self.task = task
+        self.length = length
+
+    @property
+    def name(self):
+        return self.task.name
+
+    @property
+    def desc(self):
+        return self.task.desc
+
+    def __repr__(self):
+        return f"Segment({self.task.name}, {self.length})"
+
+def task_of(item):
+    """
+    The Task behind an entry of a task list, which is either the task itself or one of its segments.
+    """
+    return item.task if isinstance(item, Segment) else item
+
+def remaining_lengths(tasks, skipped_task=None, skipped_length=None):
+    """
+    Returns Tuple(task, length still to do) for tasks, in the same order. skipped_task is being done right now, so only what's left
+    of it after skipped_length (all of it by default) counts, and it's left out if that's nothing.
+    """
+    remaining = []
+
+    for task in tasks:
+        length = task.length
+
+        if task is skipped_task:
+            length -= skipped_length if skipped_length is not None else task.length
+
+            if length <= timedelta(0):
+                continue
+
+        remaining.append((task, length))
+
+    return remaining
+
+def unplaced_tasks(tasks, task_list):
+    """
+    The tasks out of Tuple(task, length still to do) which task_list doesn't have all of, e.g. one which isn't split and is longer
+    than the time between log_on and log_off.
+    """
+    placed = {} # id(task): how much of it is in task_list
+    for _, item in task_list:
+        placed[id(task_of(item))] = placed.get(id(task_of(item)), timedelta(0)) + item.length
+
+    return [task for task, length in tasks if placed.get(id(task), timedelta(0)) < length]
+
+class TaskQueue:
+    """
+    The to-do list, ordered by due date. Tasks without a due date go at the end, in the order they were added.
+
+    Inserting is a binary search, removing a task is O(1) (it is only marked as gone, and cleared out properly once enough have built up)
+    and iterating goes over a snapshot, so the queue can be changed while it's being looped over. Tasks are found by identity, not
+    Task.__eq__, as two tasks can have the same name, description and length. Everything goes through a lock, so snapshots can be
+    taken from another thread.
+    """
+    def __init__(self, tasks=()):
+        self.keys = [] # sorted list of Tuple(has no due date, due timestamp, insertion counter), may still hold removed keys
+        self.entries = {} # key: task, only tasks which are still in the queue
+        self.positions = {} # id(task): key
+        self.counter = 0
+
+        self.cached_snapshot = None
+
+        # only the refresh thread changes the queue, but save_events takes snapshots of it from the web server's thread too
+        self.lock = threading.Lock()
+
+        self.extend(tasks)
+    
+    def make_key(self, task):
+        self.counter += 1 # keeps tasks with the same due date in the order they arrived
+
+        if task.due is None:
+            return (1, 0, self.counter)
+
+        return (0, task.due.timestamp(), self.counter)
+    
+    def insert(self, task):
+        with self.lock:
+            key = self.make_key(task)
+
+            insort(self.keys, key)
+            self.entries[key] = task
+            self.positions[id(task)] = key
+
+            self.cached_snapshot = None
+    
+    def extend(self, tasks):
+        """
+        Inserts a batch of tasks in one merge rather than one insert at a time.
+        """
+        with self.lock:
+            new_keys = []
+
+            for task in tasks:
+                key = self.make_key(task)
+
+                new_keys.append(key)
+                self.entries[key] = task
+                self.positions[id(task)] = key
+
+            if len(new_keys) == 0:
+                return
+            
+            new_keys.sort()
+            self.keys = list(heapq.merge(self.keys, new_keys))
+
+            self.cached_snapshot = None
+    
+    def discard(self, task):
+        """
+        Removes this exact task object from the queue, if it's there.
+        """
+        with self.lock:
+            key = self.positions.pop(id(task), None)
+            if key is None:
+                return
+            
+            self.entries.pop(key)
+            self.cached_snapshot = None
+
+            if len(self.keys) > 2 * len(self.entries) + 16:
+                # too many removed keys have built up, clear them out
+                self.keys = [key for key in self.keys if key in self.entries]
+    
+    def snapshot(self):
+        """
+        Returns the tasks in order as a tuple, which won't change if the queue does.
+        """
+        with self.lock:
+            if self.cached_snapshot is None:
+                self.cached_snapshot = tuple(self.entries[key] for key in self.keys if key in self.entries)
+            
+            return self.cached_snapshot
+    
+    def __iter__(self):
+        return iter(self.snapshot())
+    
+    def __len__(self):
+        return len(self.entries)
+    
+    def __contains__(self, task):
+        return id(task) in self.positions
+    
+    def __repr__(self):
+        return f"TaskQueue({list(self.snapshot())})"
+
+class Mutation:
+    """
+    A single create, update or delete to be run against the write calendar.
+    """
+    def __init__(self, kind, event, task=None):
+        self.kind = kind # "create", "update" or "delete"
+        self.event = event # an Event to create or update, or the event_id to delete
+        self.task = task
+
+        self.result = None # the Event google sent back
+        self.error = None # set if this mutation failed, everything else still goes ahead
+    
+    def __repr__(self):
+        return f"Mutation({self.kind}, {self.task})"
+
+class MutationExecutor:
+    """
+    Runs mutations on a bounded pool of threads rather than one blocking request at a time.
+    
+    The http client underneath GoogleCalendar isn't thread safe, so each worker thread builds its own link with link_factory the first
+    time it needs one. pool can be a ThreadPoolExecutor shared with other executors, otherwise one of max_workers threads is made.
+    """
+    def __init__(self, link_factory, max_workers=8, pool=None):
+        self.link_factory = link_factory
+        self.local = threading.local()
+        self.pool = pool
+
+        if self.pool is None:
+            self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="mutation")
+    
+    def get_link(self):
+        link = getattr(self.local, "link", None)
+
+        if link is None:
+            link = self.link_factory()
+            self.local.link = link
+        
+        return link
+    
+    def run_one(self, mutation):
+        link = self.get_link()
+
+        try:
+            if mutation.kind == "create":
+                try:
+                    mutation.result = link.add_event(mutation.event)
+                except HttpError as e:
+                    if e.resp.status != 409:
+                        raise
+                    # an earlier try went through even though it failed, the event is already there under the id it was given
+                    mutation.result = mutation.event
+            elif mutation.kind == "update":
+                mutation.result = link.update_event(mutation.event)
+            elif mutation.kind == "delete":
+                try:
+                    link.delete_event(mutation.event)
+                except HttpError as e:
+                    if e.resp.status not in (404, 410):
+                        raise
+                    # it's already gone, which is what we wanted
+            else:
+                raise ValueError(f"Unknown mutation kind {mutation.kind}")
+        except Exception as e:
+            mutation.error = e
+            print(f"Failed to {mutation.kind} event for {mutation.task}: {e}")
+        
+        return mutation
+    
+    def run(self, mutations):
+        """
+        Runs every mutation and returns them in the same order once they have all finished, with result or error filled in.
+        """
+        if len(mutations) == 0:
+            return []
+        
+        return list(self.pool.map(self.run_one, mutations))
+
+class ChangeSet:
+    """
+    The result of Calendar.reconcile, what needs doing to make Google Calendar match a task list.
+    """
+    def __init__(self):
+        self.keep = [] # event ids which are already correct
+        self.update = [] # Tuple(time, task, event) for events which need moving or renaming
+        self.create = [] # Tuple(time, task) which don't have an event yet
+        self.delete = [] # event ids which aren't in the task list anymore
+        self.forget = [] # event ids which no longer exist on google's side
+    
+    def __repr__(self):
+        return f"ChangeSet(keep={len(self.keep)}, update={len(self.update)}, create={len(self.create)}, delete={len(self.delete)})"
+
 class Calendar:
-    def __init__(self, active_time, inactive_time, refresh_rate=5, notify_run_client=None):
-        self.tasks_by_due = [] # every minute all of these are rechecked and uploaded
+    def __init__(self, active_time, inactive_time, refresh_rate=5, notify_run_client=None, link_factory=None, settings=None, store=None, quota=None, fetch_pool=None, mutation_pool=None, notifier=None):
+        self.tasks_by_due = TaskQueue() # every minute all of these are rechecked and uploaded
         self.tasks_pending = [] # in between the minute checks, if tasks are added in between they are placed on pending until the next refresh session
+        self.pending_lock = threading.Lock() # tasks_pending is added to from the web server's thread
 
         # the idea of the tasks_pending is so that if the program crashes in between uploads while tasks are trying to be uploaded, they will be saved as not_uploaded
         # every time tasks_pending is added to, a save should be triggered so that next time the program is ran, it will know to refresh
 
-        self.link = GoogleCalendar(write_calendar, credentials=load_service_account_credentials()) # link to google
+        # settings is this calendar's config (see tenants.py), config.json if it isn't given
+        self.settings = settings
+
+        if self.settings is None:
+            self.settings = load_settings()
+
+        # link_factory(calendar_id) gives a GoogleCalendar, or something which behaves like one (see fake_calendar.py)
+        self.link_factory = link_factory
+
+        if self.link_factory is None:
+            self.link_factory = self.google_link
+
+        self.metrics = Metrics()
+
+        # one for every link, the quota is for the whole account (tenants.py hands calendars on the same account the same one)
+        self.quota = quota
+
+        if self.quota is None:
+            self.quota = TokenBucket(self.settings.api_rate, self.settings.api_burst)
+
+        self.read_caches = {} # calendar_id: ReadCache, shared by every link to that calendar
+
+        self.link = self.connect(self.settings.write_calendar) # link to google
 
         self.calendars = []
 
-        for calendar in read_calendars:
-            self.calendars.append(GoogleCalendar(calendar, credentials=load_service_account_credentials())) # a bunch of calendars which will be read from for events
+        for calendar in self.settings.read_calendars:
+            self.calendars.append(EventStore(calendar, self.connect(calendar))) # a bunch of calendars which will be read from for events
+
+        # every calendar has its own link (and so its own http client), so they can all be fetched at the same time
+        self.fetch_pool = fetch_pool
+
+        if self.fetch_pool is None:
+            self.fetch_pool = ThreadPoolExecutor(max_workers=max(1, len(self.calendars)), thread_name_prefix="fetch")
 
         self.log_on = active_time # this should be a datetime object of the time when you start being active
         self.log_off = inactive_time
 
-        self.refresh_rate = refresh_rate # just needed for the notification system
-        self.notify = notify_run_client
+        self.refresh_rate = refresh_rate
 
-        if self.notify is None:
-            self.notify = NotifyRun(config["notify_run_url"])
+        self.executor = MutationExecutor(lambda: self.connect(self.settings.write_calendar), self.settings.mutation_workers, mutation_pool)
 
-        self.uploaded_events = [] # needs to be saved, list of Tuple(event_id, event)
-        if os.path.isfile("events.json"):
-            with open("events.json", "r") as f:
-                obj = json.loads(f.read())
+        # notify_run_client is where notifications end up (anything with send(content), e.g. notify.MemorySink), they're sent from a
+        # background thread so a slow endpoint doesn't hold up a reload
+        if notify_run_client is None:
+            notify_run_client = NotifyRun(self.settings.notify_run_url, timeout=self.settings.notify_timeout)
 
-                for key,value in obj.items():
-                    if key == "not_uploaded":
-                        for item in value: # value is here a list[task]
-                            task = Task.from_obj(item)
-                            self.tasks_pending.append(task)
-                    else:
-                        task = Task.from_obj(value)
-                        self.tasks_by_due.append(task)
+        # notifier is a Notifier whose thread can be shared with other calendars (see tenants.py)
+        if notifier is None:
+            self.notify = Notifier(notify_run_client, retries=self.settings.notify_retries, metrics=self.metrics)
+        else:
+            self.notify = notifier.channel(notify_run_client, metrics=self.metrics, retries=self.settings.notify_retries)
 
-                        self.uploaded_events.append((key,task))
+        self.uploaded_events = {} # needs to be saved, event_id: task
+        self.event_lengths = {} # saved along with it, event_id: how long the event was when it was last written
+        self.managed_events = None # event_id: Event snapshot of the write calendar, only valid for one reload cycle
 
-        self.events = self.get_events()
+        self.horizon = timedelta(days=self.settings.horizon_days)
+        self.horizon_end = None # events are only fetched up until here
+
+        self.wake = threading.Event() # set whenever something local happens which needs a reload, e.g. a new task
+        self.last_reload = None # when the last reload started
+        self.task_list = [] # the plan from the last reload, list of Tuple(time, task)
+        self.late_tasks = [] # tasks in the plan which finish after they're due
+        self.infeasible_tasks = [] # tasks which can't be finished by their due date however the plan is laid out
+        self.unplaced_tasks = [] # tasks which didn't fit anywhere in the plan
+        self.plan_memo = None # what organise_calendar worked out last time, so it only has to redo what changed
+
+        self.optimise_pool = None # only started the first time it's needed
+        self.optimised = None # Tuple(tasks in order, log_off extension) the optimiser went with last, if its plan is the one in use
+        self.currently_doing = None # Tuple(task, event) from the last reload
+        self.schedule_cache = None # Tuple(task_list, currently_doing, body, etag) for the last plan, see schedule()
+
+        self.store = store
+
+        if self.store is None:
+            self.store = TaskStore() # picks up events.json the first time it runs
+
+        loaded = {} # uid: task, the segments of a split task are saved once per event
+
+        for key,value in self.store.load().items():
+            if key == "not_uploaded":
+                for item in value: # value is here a list[task]
+                    task = Task.from_obj(item)
+                    self.tasks_pending.append(task)
+            else:
+                task = Task.from_obj(value)
+
+                if task.uid in loaded:
+                    task = loaded[task.uid]
+                else:
+                    loaded[task.uid] = task
+                    self.tasks_by_due.insert(task)
+
+                self.uploaded_events[key] = task
+
+                if "event_length" in value:
+                    self.event_lengths[key] = timedelta(minutes=value["event_length"])
+
+        # start from what the read calendars looked like last time, the first reload (in the background) catches up from there
+        self.load_snapshot()
+
+        self.events = list(heapq.merge(*(store.upcoming() for store in self.calendars)))
+        self.busy = IntervalIndex(self.events)
     
     def check_access_token():
         pass
     
+    def google_link(self, calendar_id):
+        from gcsa.google_calendar import GoogleCalendar
+
+        credentials = load_service_account_credentials(self.settings.service_account_file_name) # read once for every calendar using the file
+
+        return GoogleCalendar(calendar_id, credentials=credentials)
+    
+    def load_snapshot(self):
+        """
+        MODIFIES self.calendars, self.horizon_end
+
+        Puts back the read calendars' events and sync tokens from the last run, so nothing has to be downloaded before the plan can
+        be looked at, and the first sync only asks for what changed since.
+        """
+        snapshot = self.store.load_snapshot("horizon")
+        if snapshot is None:
+            return
+        
+        self.horizon_end = datetime.fromisoformat(snapshot["horizon_end"])
+
+        for store in self.calendars:
+            snapshot = self.store.load_snapshot(f"calendar:{store.calendar_id}")
+
+            if snapshot is not None:
+                store.restore(snapshot)
+    
+    def save_snapshot(self):
+        """
+        Saves the read calendars which changed since last time, for load_snapshot.
+        """
+        if self.horizon_end is None:
+            return
+        
+        self.store.save_snapshot("horizon", {"horizon_end": self.horizon_end.isoformat()})
+
+        for store in self.calendars:
+            if store.dirty:
+                self.store.save_snapshot(f"calendar:{store.calendar_id}", store.snapshot())
+                store.dirty = False
+    
+    def connect(self, calendar_id):
+        cache = self.read_caches.setdefault(calendar_id, ReadCache(self.settings.api_cache_ttl))
+
+        return MeteredLink(lambda: self.link_factory(calendar_id), self.metrics, self.quota, cache, self.settings.api_retries, self.settings.api_backoff)
+    
+    def update_gauges(self):
+        self.metrics.set("queue_depth", len(self.tasks_by_due))
+        self.metrics.set("pending_tasks", len(self.tasks_pending))
+        self.metrics.set("uploaded_events", len(self.uploaded_events))
+        self.metrics.set("events", len(self.events))
+        self.metrics.set("busy_intervals", len(self.busy))
+        self.metrics.set("late_tasks", len(self.late_tasks))
+        self.metrics.set("infeasible_tasks", len(self.infeasible_tasks))
+        self.metrics.set("unplaced_tasks", len(self.unplaced_tasks))
+    
     def start(self):
         self.reload_tasks()
     
@@ -190,44 +864,83 @@ class Calendar:
         # { event_id: event, ... , not_uploaded: [event, ...]}
         obj = {}
 
-        # merge tasks_by_due and tasks_pending
-        
-        obj["not_uploaded"] = [x.obj() for x in self.tasks_pending]
+        # merge tasks_by_due and tasks_pending. anything in the queue without an event (its create failed, or it didn't fit in the
+        # plan) is saved as not_uploaded too, otherwise it would be gone after a restart
+
+        uploaded_events = list(self.uploaded_events.items()) # this can be called from the web server's thread as well
+        uploaded = {id(task) for _, task in uploaded_events}
+
+        with self.pending_lock:
+            pending = list(self.tasks_pending)
+
+        pending += [task for task in self.tasks_by_due.snapshot() if id(task) not in uploaded]
+        obj["not_uploaded"] = [x.obj() for x in pending]
 
-        for i,task in self.uploaded_events:
+        event_lengths = dict(self.event_lengths)
+
+        for i,task in uploaded_events:
             obj[i] = task.obj()
+
+            if i in event_lengths:
+                obj[i]["event_length"] = round(event_lengths[i].total_seconds() / 60)
         
-        # now save
+        # now save, only the records which changed since last time are written
 
-        with open("events.json", "w") as f:
-            f.write(json.dumps(obj))
+        self.store.commit(obj)
     
     def get_events(self):
         """
         DOES NOT MODIFY self.tasks_by_due
         
-        Get all upcoming events from Google Calendar which are not tasks managed by this app.
+        Get all upcoming events from Google Calendar which are not tasks managed by this app as Tuple(start, end) in epoch minutes,
+        sorted by start time across every calendar.
         """
-        events = []
+        self.extend_horizon()
 
-        for link in self.calendars:
-            for event in sorted(link.get_events()):
-                if not (event.description is not None and event.description.endswith(tag)):
-                    events.append(event)
+        # the calendars are fetched in parallel, so this takes as long as the slowest calendar rather than all of them added up
+        streams = list(self.fetch_pool.map(self.fetch_store, self.calendars))
+
+        # each calendar is already sorted, so a k-way merge gives the global order without sorting everything again
+        events = list(heapq.merge(*streams))
             
-        print(len(events))
-        
         return events
+    
+    def fetch_store(self, store):
+        if self.settings.incremental_sync:
+            store.sync(self.horizon_end)
+        else:
+            store.full_sync(self.horizon_end)
+        
+        return store.upcoming()
+    
+    def extend_horizon(self, until=None):
+        """
+        Makes sure events are fetched at least self.horizon ahead of now, and up until until if it is given.
+
+        Returns True if the horizon moved, in which case the read calendars will be fetched again in full on the next update.
+        """
+        needed = datetime.now(local_timezone) + self.horizon
+
+        if until is not None and until > needed:
+            needed = until
+
+        if self.horizon_end is not None and needed <= self.horizon_end:
+            return False
+        
+        # leave some slack so the horizon (and with it every read calendar) isn't moved on every refresh
+        self.horizon_end = needed + self.horizon / 2
+        return True
 
     def update_events(self):
         self.events = self.get_events()
+        self.busy = IntervalIndex(self.events) # merged across every read calendar, rebuilt once per refresh
     
     def get_tasks(self, delete=False):
         """
         DOES NOT MODIFY self.tasks_by_due
         
         Get all upcoming tasks from Google calendar which are managed by this app.
-        TODO: deprecate this and use events.json to get events managed by this app.
+        TODO: deprecate this and use the task store to get events managed by this app.
         """
         tasks = []
 
@@ -244,66 +957,174 @@ class Calendar:
         """
         MODIFIES self.tasks_by_due
 
-        Inserts a Task object into the to-do list.
+        Inserts a Task object into the to-do list. Anything outside the thread doing the reloads (e.g. the web server) goes through
+        add_tasks instead, so the task is saved straight away and only the refresh thread changes the queue.
         """
-        if task.due is None:
-            self.tasks_by_due.append(task)
-            return
-        
-        inserted = False
-        for i,v in enumerate(self.tasks_by_due):
-            if v.due is None:
-                inserted = i
-                break
+        self.wake.set()
 
-            if v.due > task.due:
-                self.tasks_by_due.insert(i,task)
-                inserted = True
-                break
-        
-        if inserted is not True:
-            self.tasks_by_due.insert(inserted,task) # the index in which the tasks start to have no due date
+        self.tasks_by_due.insert(task)
+    
+    def add_tasks(self, tasks):
+        """
+        MODIFIES self.tasks_pending
+
+        Adds a batch of tasks in one go. They are saved as not_uploaded straight away (once for the whole batch), and merged into
+        self.tasks_by_due together on the next reload.
+        """
+        with self.pending_lock:
+            self.tasks_pending.extend(tasks)
+
+        self.save_events()
+
+        self.wake.set()
     
     def merge_pending(self):
-        for _ in self.tasks_pending:
-            self.insert_task(self.tasks_pending.pop())
+        # swap the list out first, so nothing is skipped (or lost if another thread adds a task part way through)
+        with self.pending_lock:
+            pending, self.tasks_pending = self.tasks_pending, []
 
-    def upload_task_list(self,task_list):
+        self.tasks_by_due.extend(pending)
+
+    def create_mutations(self, task_list):
+        mutations = []
+
+        for time,task in task_list:
+            # the id is chosen here rather than by google, so a create which is retried after it went through (e.g. a 5xx sent after
+            # the event was made) can't leave a second event behind which nothing knows about. uuid4().hex only uses characters google
+            # allows in ids
+            event = Event(start=time,end=time+task.length,description=task.desc+tag,color_id=GCColour.TOMATO.value,summary=task.name,event_id=uuid4().hex)
+
+            mutations.append(Mutation("create", event, task_of(task))) # segments are recorded against the task they belong to
+
+        return mutations
+
+    def apply_mutations(self, mutations):
         """
-        Takes a List[Tuple[datetime, Task]] and uploads all tasks as events onto Google Calendar.
+        MODIFIES self.uploaded_events
+
+        Runs the mutations through the executor, and only records the ones which succeeded in self.uploaded_events.
+        Anything which failed is left as it was, so the next refresh will try it again.
         """
-        for time,task in task_list:
-            event = Event(start=time,end=time+task.length,description=task.desc+tag,color_id=GCColour.TOMATO.value,summary=task.name)
+        for mutation in self.executor.run(mutations):
+            if mutation.error is not None:
+                continue
 
-            event = self.link.add_event(event)
+            if mutation.kind == "create":
+                self.uploaded_events[mutation.result.event_id] = mutation.task
+                self.event_lengths[mutation.result.event_id] = mutation.event.end - mutation.event.start
+            elif mutation.kind == "update":
+                self.event_lengths[mutation.event.event_id] = mutation.event.end - mutation.event.start
+            elif mutation.kind == "delete":
+                self.uploaded_events.pop(mutation.event, None)
+                self.event_lengths.pop(mutation.event, None)
 
-            self.uploaded_events.append((event.event_id, task))
+    def upload_task_list(self,task_list):
+        """
+        Takes a List[Tuple[datetime, Task]] and uploads all tasks as events onto Google Calendar.
+        """
+        self.apply_mutations(self.create_mutations(task_list))
         
         self.save_events()
     
     def check_event_updates(self):
         """
-        Goes through all of the tasks uploaded, and checks for modifications. If modified, update the clientside tasks to the ones prompted by the user.        
+        MODIFIES self.tasks_by_due, self.uploaded_events, self.event_lengths
+
+        Goes through all of the tasks uploaded, and checks for modifications. If modified, update the clientside tasks to the ones prompted by the user.
+
+        A split task has an event for each segment. Marking a segment green takes its time off the task (and forgets the event, so it
+        stays on the calendar as done), and the task is only finished once there is nothing left of it.
         """
+        events_by_task = {} # id(task): Tuple(task, list of events)
         for task, event in self.get_uploaded_tasks():
-            if event.start is not None and event.end is not None:
-                length = round((event.end - event.start).total_seconds() / 60)
+            events_by_task.setdefault(id(task), (task, []))[1].append(event)
 
-                if length != round(task.length.total_seconds() / 60):
-                    task.length = timedelta(minutes=length)
-            
-            if event.summary != task.name:
-                task.name = event.summary
+        changed = False
+
+        for task, events in events_by_task.values():
+            for event in events:
+                description = event.description or "" # None if the user cleared it
+
+                if event.summary != task.name:
+                    task.name = event.summary
+                
+                if description != task.desc + tag:
+                    task.desc = description[:-len(tag)] if description.endswith(tag) else description
             
-            if event.description != task.desc + tag:
-                task.desc = event.description[:len(tag)]
+            for event in events:
+                if event.color_id in [GCColour.BASIL.value, GCColour.SAGE.value]:
+                    if event.start is not None and event.end is not None and task.split:
+                        task.length -= event.end - event.start
+                    else:
+                        task.length = timedelta(0)
+
+                    self.uploaded_events.pop(event.event_id, None)
+                    self.event_lengths.pop(event.event_id, None)
+                    changed = True
+                    continue
+
+                if event.start is None or event.end is None:
+                    continue
+
+                # only what the user changed about an event counts, not which events happen to be there: a segment whose create
+                # failed still has to be planned, so the task can't just be as long as the events it has
+                length = event.end - event.start
+                written = self.event_lengths.get(event.event_id)
+
+                if written is None:
+                    # uploaded before lengths were kept, a task which isn't split is as long as its event
+                    if not task.split and length != task.length:
+                        task.length = length
+                        changed = True
+                elif length != written:
+                    task.length += length - written
+                    changed = True
+
+                self.event_lengths[event.event_id] = length
             
-            if event.color_id in [GCColour.BASIL.value, GCColour.SAGE.value]:
-                for i,t in enumerate(self.tasks_by_due):
-                    if task == t:
-                        self.tasks_by_due.pop(i)
+            if task.length <= timedelta(0):
+                self.tasks_by_due.discard(task)
+                changed = True
+        
+        if changed:
+            self.save_events()
+
+    def get_managed_events(self):
+        """
+        Gets every event managed by this app on the write calendar as a dict of event_id: Event with a single list query.
+        
+        The result is kept until invalidate_managed_events() is called, so everything in one reload cycle shares the same snapshot.
+        """
+        if self.managed_events is not None:
+            return self.managed_events
+        
+        # to the minute, so reloads close together ask for the same window and can share what's in the read cache
+        now = datetime.now(local_timezone).replace(second=0, microsecond=0)
+        
+        events = {}
 
-                        self.save_events()
+        self.extend_horizon()
+
+        # start a day back so the task currently being done (and anything which just finished) is still in the window
+        for event in self.link.get_events(time_min=now - timedelta(days=1), time_max=self.horizon_end, single_events=True):
+            if event.description and event.description.endswith(tag):
+                events[event.event_id] = event
+        
+        # anything uploaded outside of the window is fetched on its own
+        for event_id in self.uploaded_events:
+            if event_id not in events:
+                try:
+                    events[event_id] = self.link.get_event(event_id)
+                except HttpError as e:
+                    if e.resp.status not in (404, 410):
+                        raise
+                    # deleted on google's side, reconcile() will forget about it
+        
+        self.managed_events = events
+        return events
+    
+    def invalidate_managed_events(self):
+        self.managed_events = None
 
     def get_uploaded_tasks(self, filterCompleted=False):
         """
@@ -311,8 +1132,13 @@ class Calendar:
         """
         tasks = []
 
-        for event_id, task in self.uploaded_events:
-            event = self.link.get_event(event_id)
+        managed_events = self.get_managed_events()
+
+        for event_id, task in self.uploaded_events.items():
+            event = managed_events.get(event_id)
+            if event is None:
+                continue
+
             if filterCompleted and event.color_id in [GCColour.BASIL.value, GCColour.SAGE.value]:
                 # it's completed (marked as green), skip it
                 continue
@@ -321,108 +1147,468 @@ class Calendar:
 
         return tasks
     
-    def organise_calendar(self, starting_time = None, skipped_task = None):
+    def reconcile(self, task_list, currently_doing=None):
+        """
+        DOES NOT MODIFY self.uploaded_events
+
+        Compares a task list from organise_calendar against the uploaded events and works out the smallest set of changes to make
+        Google Calendar match it. Events are matched to the task list by the task object they were uploaded for, not by time.
+        """
+        changes = ChangeSet()
+
+        managed_events = self.get_managed_events()
+
+        planned = {} # id(task): list of Tuple(time, task or segment)
+        for time, item in task_list:
+            planned.setdefault(id(task_of(item)), []).append((time, item))
+        
+        uploaded = {} # id(task): list of events
+        for event_id, task in self.uploaded_events.items():
+            event = managed_events.get(event_id)
+
+            if event is None:
+                changes.forget.append(event_id)
+                continue
+
+            if currently_doing is not None and event_id == currently_doing[1].event_id:
+                continue # leave the event being done right now alone, the rest of a split task still gets planned
+
+            uploaded.setdefault(id(task), []).append(event)
+        
+        for key, events in uploaded.items():
+            events.sort(key=lambda event: event.start)
+            slots = sorted(planned.pop(key, []), key=lambda slot: slot[0])
+
+            # pair the events up with the planned slots for the same task in time order
+            for event, (time, task) in zip(events, slots):
+                if task.name == event.summary and task.length == (event.end - event.start) and task.desc + tag == event.description and time == event.start:
+                    changes.keep.append(event.event_id)
+                else:
+                    changes.update.append((time, task, event))
+            
+            for event in events[len(slots):]:
+                changes.delete.append(event.event_id)
+            
+            changes.create.extend(slots[len(events):])
+        
+        for slots in planned.values():
+            changes.create.extend(slots)
+        
+        return changes
+
+    def organise_calendar(self, starting_time = None, skipped_task = None, skipped_length = None, tasks = None, dry_run = False):
         """
         DOES NOT MODIFY self.tasks_by_due
 
         Creates a valid new calendar, organising tasks by due date and around events.
+
+        tasks (in due order) is planned instead of self.tasks_by_due if it's given. A dry run is planned from scratch against the events
+        already fetched, and leaves self alone (the memo, late tasks and so on), so it can run alongside a reload.
         
         To be implemented in order of priority:
         1) (Assuming all tasks are assignable easily in the order by due date) lay out all tasks by due date. ✅
-        2) Lay out all tasks by due date if tasks can be switched around and still give a valid layout. (ex: short task taking up space on day 2 when day 1 has a gap free for it)
+        2) Lay out all tasks by due date if tasks can be switched around and still give a valid layout. (ex: short task taking up space on day 2 when day 1 has a gap free for it) ✅ (backfilled, and optimise_plan swaps tasks around if turned on)
             - do 2 layers of recursion, in which we heuristically swap two random events, check the layout's validity and keep going#
             - if this fails, move onto step 3
-        3) Split up tasks into smaller segments (if needed and opted in)
-        4) If the layout isn't possible and you're swamped, extend log_off time by increments of 30 minutes (includes log_off time being technically before log_on time, if log_off is 2am and log_on is 7am)
+        3) Split up tasks into smaller segments (if needed and opted in) ✅
+        4) If the layout isn't possible and you're swamped, extend log_off time by increments of 30 minutes (includes log_off time being technically before log_on time, if log_off is 2am and log_on is 7am) ✅ (optimise_plan, if turned on)
+        """
+
+        fifteen_minutes = timedelta(minutes=15)
+        working_time = self.working_start(starting_time)
+
+        # earliest deadline first: go through the tasks in due order, and put each one in the earliest gap of free time (active hours
+        # minus events) it fits in, on the 15 minute grid. gaps a task was too long for stay open, so shorter tasks due later get
+        # pulled forward into them
+
+        longest_gap = window_length(self.log_on, self.log_off) // minute # the gap engine works in whole minutes
+
+        tasks = remaining_lengths(self.tasks_by_due.snapshot() if tasks is None else tasks, skipped_task, skipped_length)
+
+        # what each task's placement depends on. the tasks at the front which are the same as last time (with nothing before them
+        # changing) keep their places, and only the rest are placed again
+        inputs = [(task, length, task.split, task.min_segment) for task, length in tasks]
+
+        if dry_run:
+            memo, reused = self.fresh_plan(working_time, fifteen_minutes, longest_gap), 0
+        else:
+            memo, reused = self.reuse_plan(inputs, working_time, fifteen_minutes, longest_gap)
+
+        pool = memo.pool
+
+        for (task, length), key in zip(tasks[reused:], inputs[reused:]):
+            mark = len(pool.log)
+            placements = []
+
+            if task.split:
+                # split tasks go into the earliest gaps which can hold a segment, each segment getting its own event
+                pieces = pool.place_split(length // minute, task.min_segment // minute)
+                placements = [(from_minutes(start, local_timezone), Segment(task, piece * minute)) for start, piece in pieces]
+            elif length // minute <= longest_gap: # otherwise this can never fit between log_on and log_off
+                start = pool.place(length // minute)
+
+                if start is not None:
+                    placements = [(from_minutes(start, local_timezone), task if length == task.length else Segment(task, length))]
+            
+            memo.add(key, placements, mark)
+
+        task_list = [entry for placements in memo.placements for entry in placements] # tuple(time: starting_time, task: task assigned to this time)
+        task_list.sort(key=lambda x: x[0])
+
+        if dry_run:
+            return task_list
+
+        self.plan_memo = memo
+        self.metrics.set("plan_reused_tasks", reused)
+
+        # work out which tasks miss their due date, and which of those couldn't have made it however they were laid out
+
+        self.late_tasks = self.find_late_tasks(task_list)
+        self.unplaced_tasks = unplaced_tasks(tasks, task_list)
+        self.infeasible_tasks = self.find_infeasible_tasks(tasks, self.late_tasks, self.unplaced_tasks, working_time)
+        
+        return task_list
+
+    def working_start(self, starting_time=None):
+        """
+        Where a plan starts: starting_time if it's given, otherwise the first multiple of 15 minutes after now.
         """
+        if starting_time is not None:
+            return starting_time
 
         # let's find the first active moment that's a multiple of 15 minutes after when this is being run
 
         fifteen_minutes = timedelta(minutes=15)
-        if starting_time is None:
-            now = datetime.now(local_timezone) 
-
-            current_minute = now.minute
-            if current_minute % 15 != 0:
-                # i couldn't think of a better way to do this
-                for i in range(15):
-                    current_minute -= 1
-                    if current_minute % 15 == 0:
-                        break
+        now = datetime.now(local_timezone) 
+
+        current_minute = now.minute
+        if current_minute % 15 != 0:
+            # i couldn't think of a better way to do this
+            for i in range(15):
+                current_minute -= 1
+                if current_minute % 15 == 0:
+                    break
+        
+        now = now.replace(minute=current_minute,second=0,microsecond=0)
+        now += fifteen_minutes # this is now the first 15 minute starter
+
+        # inactive hours don't need skipping here, free_gaps only hands out time between log_on and log_off
+        return now
+
+    def find_late_tasks(self, task_list):
+        """
+        The tasks in task_list whose last segment finishes after they're due.
+        """
+        finish = {} # id(task): Tuple(task, when its last segment ends)
+        for time, item in task_list:
+            task = task_of(item)
+            if task.due is not None and (id(task) not in finish or finish[id(task)][1] < time + item.length):
+                finish[id(task)] = (task, time + item.length)
+
+        return [task for task, end in finish.values() if end > task.due]
+
+    def find_infeasible_tasks(self, tasks, late_tasks, unplaced, working_time):
+        """
+        The tasks out of Tuple(task, length still to do) which can't be finished by their due date however the plan is laid out,
+        in due order. That's any which couldn't be placed at all and have a due date, as well as the ones infeasible_tasks finds.
+        """
+        infeasible = {id(task) for task in unplaced if task.due is not None}
+
+        if len(late_tasks) > 0:
+            infeasible.update(id(task) for task in infeasible_tasks(tasks, free_gaps(self.busy, self.log_on, self.log_off, working_time)))
+
+        return [task for task, _ in tasks if id(task) in infeasible]
+
+    def optimise_plan(self, task_list):
+        """
+        DOES NOT MODIFY self.tasks_by_due
+
+        Runs the local search in optimiser.py over the plan organise_calendar just made, in worker processes for optimise_budget
+        seconds. Returns the best layout found as a task list, or task_list if nothing was better than it.
+
+        The search starts from the layout it picked last time (if that's better than task_list), so the calendar only moves when
+        something better turns up, not every time the search happens to land somewhere else.
+        """
+        memo = self.plan_memo
+        tasks = [task for task, _, _, _ in memo.inputs]
+
+        # in minutes, which is what the gap engine works in
+        details = [(length // minute, to_minutes(task.due) if task.due is not None else None, split, minimum // minute) for task, length, split, minimum in memo.inputs]
+        allowed = optimiser.extensions(self.log_on, self.log_off, timedelta(minutes=self.settings.max_log_off_extension))
+
+        problem = optimiser.Problem(self.log_on, self.log_off, memo.working_time, self.busy, details, 15, allowed)
+
+        order = list(range(len(tasks)))
+        extension = timedelta(0)
+        score = optimiser.Layout(problem, order, extension).score() # the greedy plan, it's always the first task order
+
+        if self.optimised is not None:
+            last_tasks, last_extension = self.optimised
+            positions = {id(task): i for i, task in enumerate(tasks)}
+
+            last_order = [positions[id(task)] for task in last_tasks if id(task) in positions]
+            seen = set(last_order)
+            last_order += [i for i in order if i not in seen] # new tasks go on the end, in due order
+
+            if last_extension in problem.extensions:
+                last_score = optimiser.Layout(problem, last_order, last_extension).score()
+
+                if last_score < score:
+                    order, extension, score = last_order, last_extension, last_score
+
+        if self.optimise_pool is None:
+            self.optimise_pool = optimiser.process_pool(self.settings.optimise_workers)
+
+        try:
+            result = optimiser.optimise(self.optimise_pool, problem, order, extension, self.settings.optimise_budget, self.settings.optimise_workers)
+        except Exception as e:
+            print(f"The optimiser failed, keeping the greedy plan: {e}")
+            result = None
+
+        if result is not None and result[0] < score:
+            score, order, extension = result
+
+        if order == list(range(len(tasks))) and extension == timedelta(0):
+            self.optimised = None
+            return task_list # the greedy plan is still the best
+
+        self.optimised = ([tasks[i] for i in order], extension)
+        self.metrics.set("optimised_log_off_extension_minutes", extension.total_seconds() / 60)
+
+        layout = optimiser.Layout(problem, order, extension)
+
+        optimised = []
+        for index, pieces in zip(layout.order, layout.placements):
+            task, length, split, _ = memo.inputs[index]
+
+            for start, piece in pieces:
+                start, piece = from_minutes(start, local_timezone), piece * minute
+                optimised.append((start, task if not split and piece == task.length else Segment(task, piece)))
+        
+        optimised.sort(key=lambda x: x[0])
+
+        self.late_tasks = self.find_late_tasks(optimised)
+        self.unplaced_tasks = unplaced_tasks([(task, length) for task, length, _, _ in memo.inputs], optimised)
+
+        return optimised
+
+    def reuse_plan(self, inputs, working_time, step, longest_gap):
+        """
+        Works out how much of the last plan still holds for the tasks described by inputs, and returns Tuple(memo, number of tasks
+        kept). The memo's pool has just the time those tasks take up taken out of it, ready for the rest to be placed.
+        """
+        memo = self.plan_memo
+        fresh = lambda: self.fresh_plan(working_time, step, longest_gap)
+
+        if memo is None or memo.log_on != self.log_on or memo.log_off != self.log_off or (working_time - memo.working_time) % step != timedelta(0):
+            return fresh(), 0 # the grid isn't the same, so nothing would land in the same place
+        
+        kept = memo.common_prefix(inputs)
+        changed = memo.busy.first_difference(self.busy)
+
+        if working_time == memo.working_time and changed is None:
+            # the same free time as last time, so the tasks after the first changed one just give their time back
+            memo.truncate(kept)
+            memo.busy = self.busy
+
+            return memo, kept
+        
+        # the free time changed somewhere, so the tasks placed before that (and after the plan now starts) go back in the same places
+        kept = memo.valid_prefix(kept, working_time, changed)
+        new = fresh()
+
+        for i in range(kept):
+            mark = len(new.pool.log)
+
+            if not all(new.pool.reserve(to_minutes(start), item.length // minute) for start, item in memo.placements[i]):
+                new.pool.rollback(mark)
+                return new, i
             
-            now = now.replace(minute=current_minute,second=0,microsecond=0)
-            now += fifteen_minutes # this is now the first 15 minute starter
+            new.add(memo.inputs[i], memo.placements[i], mark)
+        
+        return new, kept
+
+    def fresh_plan(self, working_time, step, longest_gap):
+        """
+        An empty PlanMemo, with all of the free time from working_time onwards in its pool.
+        """
+        gaps = free_gaps(self.busy, self.log_on, self.log_off, working_time)
 
-            now_time = now.time()
+        return PlanMemo(self.log_on, self.log_off, working_time, self.busy, GapPool(gaps, to_minutes(working_time), step // minute, longest_gap))
 
-            if (now_time < self.log_on) or (now_time > self.log_off): # this assumes that if placed on the same day, log_on would be before log_off
-                # we're in inactive hours, skip ahead to you logging on
+    def plan(self, starting_time=None, skipped_task=None, skipped_length=None):
+        """
+        DOES NOT MODIFY self.tasks_by_due
+
+        organise_calendar, but if the plan runs past the events we know about, the horizon is pushed out and it is planned again.
+
+        If optimise is on in config.json and the plan has late tasks, optimise_plan gets a go at it as well.
+        """
+        while True:
+            task_list = self.organise_calendar(starting_time=starting_time, skipped_task=skipped_task, skipped_length=skipped_length)
+
+            if self.settings.optimise and len(self.late_tasks) > 0:
+                with self.metrics.phase("optimise"):
+                    task_list = self.optimise_plan(task_list)
+            else:
+                self.optimised = None
 
-                while (now_time < self.log_on) or (now_time > self.log_off):
-                    # continue adding 15 minutes until it is a valid time
-                    now += fifteen_minutes
-                    now_time = now.time()
+            if len(task_list) == 0:
+                return task_list
             
-            working_time = contextualise(now_time, now)
-        else:
-            working_time = starting_time
+            plan_end = max(time + task.length for time, task in task_list)
 
-        task_list = [] # tuple(time: starting_time, task: task assigned to this time)
+            if not self.extend_horizon(plan_end):
+                return task_list
 
-        # keep skipping forwards fifteen minutes until a slot is found which doesn't collide with log_off time and any scheduled events
+            self.update_events()
 
-        tasks_by_due = copy(self.tasks_by_due)
+    def describe_plan(self, task_list, late_tasks, infeasible_tasks, unplaced, currently_doing):
+        """
+        A task list as a dict which can be turned into json, for /schedule. Tasks are referred to by their id.
+        """
+        entries = []
+
+        for time, item in task_list:
+            task = task_of(item)
+
+            entries.append({
+                "id": task.uid,
+                "name": item.name,
+                "desc": item.desc,
+                "start": time.isoformat(),
+                "end": (time + item.length).isoformat(),
+                "due": task.due.isoformat() if task.due is not None else None,
+                "segment": isinstance(item, Segment),
+            })
+
+        current = None
+        if currently_doing is not None:
+            task, event = currently_doing
+            current = {"id": task_of(task).uid, "name": event.summary, "start": event.start.isoformat(), "end": event.end.isoformat()}
+
+        return {
+            "current": current,
+            "tasks": entries,
+            "late": [task.uid for task in late_tasks],
+            "infeasible": [task.uid for task in infeasible_tasks],
+            "unplaced": [task.uid for task in unplaced],
+        }
 
-        for _ in range(len(tasks_by_due)):
-            task = tasks_by_due.pop(0)
+    def schedule(self):
+        """
+        DOES NOT MODIFY self.tasks_by_due
 
-            if task == skipped_task:
-                continue
-                # task doesn't make it onto the task_list
+        The plan from the last reload as Tuple(json body, etag). It's only turned into json again once there's a new plan, and the etag
+        only changes when the plan does, so anything polling it can be told nothing changed.
+        """
+        task_list, currently_doing = self.task_list, self.currently_doing
+        cache = self.schedule_cache
 
-            while True: # logic to break is too complicated to be handled in a statement
-                valid = True
+        if cache is None or cache[0] is not task_list or cache[1] is not currently_doing:
+            body = json.dumps(self.describe_plan(task_list, self.late_tasks, self.infeasible_tasks, self.unplaced_tasks, currently_doing), sort_keys=True)
+            etag = hashlib.sha1(body.encode("utf-8")).hexdigest()
 
-                end = working_time + task.length
+            cache = self.schedule_cache = (task_list, currently_doing, body, etag)
 
-                # consider a number line and the intersection of 2 1d segments
-                # additionally, if the log_on or log_off lies within working_time and end, it is also invalid (this logic is harder though)
+        return cache[2], cache[3]
 
-                # if the starting time of the event we are on is after end, then we can break the loop (iterating through events is hard when it goes through the next year's worth)
+    def preview(self, tasks):
+        """
+        DOES NOT MODIFY self.tasks_by_due
 
-                for event in self.events:
-                    # check for collisions as described above
-                    if times_intersect(working_time, end, event.start, event.end):
-                        valid = False
-                        break # we don't need to check any more
+        What the plan would be if tasks were added, as a dict like describe_plan gives. It's planned in-process against the events
+        fetched by the last reload, without talking to google, and the optimiser isn't run.
+        """
+        # everything which will be in the next plan, in the order the queue would put it in
+        queue = TaskQueue(list(self.tasks_by_due.snapshot()) + list(self.tasks_pending) + list(tasks))
 
-                    if event.start > end:
-                        # all further events are after this
-                        break
-                
-                # log_on log_off collision cases:
-                # log_on start log_off end
-                # log_on start log_off log_on .... end
+        starting_time = skipped_task = skipped_length = None
+
+        currently_doing = self.currently_doing
+        if currently_doing is not None and currently_doing[1].end > datetime.now(local_timezone):
+            task, event = currently_doing
+            starting_time, skipped_task, skipped_length = event.end, task, event.end - event.start
+        else:
+            currently_doing = None
 
-                # place the log_off time on the date at which the task will be done
-                day_specific_log_off = contextualise(self.log_off, working_time)
+        working_time = self.working_start(starting_time)
+        task_list = self.organise_calendar(working_time, skipped_task, skipped_length, tasks=queue.snapshot(), dry_run=True)
 
-                if end > day_specific_log_off:
-                    # this is an impossible configuration, it isn't valid
-                    valid = False
-                
-                # currently the assumption is that all tasks are able to be fit in order before the due date, so task.due isn't referenced yet
-                # TODO: task.due
+        planned = remaining_lengths(queue.snapshot(), skipped_task, skipped_length)
 
-                if valid is True:
-                    break
+        late = self.find_late_tasks(task_list)
+        unplaced = unplaced_tasks(planned, task_list)
+        infeasible = self.find_infeasible_tasks(planned, late, unplaced, working_time)
+
+        return self.describe_plan(task_list, late, infeasible, unplaced, currently_doing)
+
+    def next_deadline(self):
+        """
+        The next moment the plan from the last reload stops being right on its own: when the current task ends, when the warning before
+        it ends is due, or when the next planned task starts. None if there isn't one.
+        """
+        if self.last_reload is None:
+            return None
 
-                working_time += fifteen_minutes
+        moments = []
 
-            task_list.append((working_time, task))
-            working_time += task.length
+        if self.currently_doing is not None:
+            end = self.currently_doing[1].end
+
+            moments.append(end)
+            moments.append(end - timedelta(minutes=notify_before_warning))
         
-        return task_list
+        if len(self.task_list) > 0:
+            moments.append(min(time for time, _ in self.task_list))
+        
+        moments = [moment for moment in moments if moment > self.last_reload]
+
+        if len(moments) == 0:
+            return None
+        
+        return min(moments)
+    
+    def poll_changes(self):
+        """
+        Cheaply checks whether anything changed on Google since the last reload. The read calendars are synced (just their changes
+        with a sync token), and the write calendar is asked for a single event updated since the last reload.
+        """
+        if self.last_reload is None:
+            return True
+
+        self.extend_horizon()
+
+        changed = any(list(self.fetch_pool.map(lambda store: store.sync(self.horizon_end), self.calendars)))
+
+        if changed:
+            return True
+        
+        # this also picks up the changes our own last reload made, which costs one extra (empty) reload afterwards. it looks back as
+        # far as reads are cached for, since the last reload might have been given a cached copy from before a change
+        since = self.last_reload - timedelta(seconds=self.settings.api_cache_ttl)
+        response = self.link.list_raw(calendarId=self.settings.write_calendar, updatedMin=since.isoformat(), showDeleted=True, maxResults=1)
+
+        if len(response.get("items", [])) > 0:
+            self.link.cache.clear() # so the reload sees the change
+            return True
+        
+        return False
+    
+    def needs_reload(self):
+        """
+        Whether reload_tasks has any work to do: something local happened, a deadline from next_deadline() has passed, or something
+        changed on Google.
+        """
+        if self.wake.is_set() or len(self.tasks_pending) > 0:
+            self.wake.clear()
+            return True
+        
+        deadline = self.next_deadline()
+        if deadline is not None and deadline <= datetime.now(local_timezone):
+            return True
+        
+        return self.poll_changes()
 
     def reload_tasks(self):
         """
@@ -432,9 +1618,21 @@ class Calendar:
         # if the time is in the middle of a task, organise_calendar will shift this task along infinitely and we don't want that to happen
         # redesign organise_calendar to fit this description
 
-        self.merge_pending() # now the entire list is back together and happy
-        self.check_event_updates() # now we're up to date with the server
-        self.update_events() # ""
+        self.last_reload = datetime.now(local_timezone)
+
+        self.invalidate_managed_events() # take a fresh snapshot of the write calendar for this cycle
+
+        self.metrics.start_tick()
+        calls = self.metrics.total("api_calls_total")
+
+        with self.metrics.phase("merge_pending"):
+            self.merge_pending() # now the entire list is back together and happy
+        
+        with self.metrics.phase("check_event_updates"):
+            self.check_event_updates() # now we're up to date with the server
+        
+        with self.metrics.phase("update_events"):
+            self.update_events() # ""
 
         # find the event that is currently being done. if multiple are currently ongoing, pick the one that started first, and if they both started first, pick the one that ends the first. if then necessary, pick the one with the earliest name alphabetically.
 
@@ -492,73 +1690,79 @@ class Calendar:
         # now we have the currently doing event if it exists, we can now try reorganise
 
         if currently_doing is None:
-            task_list = self.organise_calendar()
+            with self.metrics.phase("organise"):
+                task_list = self.plan()
         else:
             # custom organise in which the starting_time is determined, as well as the first task being removed
             starting_time = currently_doing[1].end # start when this ends
             
-            task_list = self.organise_calendar(starting_time=starting_time, skipped_task=currently_doing[0])
+            with self.metrics.phase("organise"):
+                task_list = self.plan(starting_time=starting_time, skipped_task=currently_doing[0], skipped_length=currently_doing[1].end - currently_doing[1].start)
 
             # let's make the check now to see if we're in the time period to notify
 
             notify_time = starting_time - timedelta(minutes=notify_before_warning)
-            td = timedelta(seconds=(self.refresh_rate+1)/2)
-
-            lbound = notify_time - td
-            ubound = notify_time + td
 
+            # any reload after notify_time will do (they don't always line up with it), the notifier only sends it once per event
             current_time = datetime.now(local_timezone) 
-            if lbound <= current_time and current_time <= ubound:
+            if current_time >= notify_time:
                 # if the task is still red
-                if currently_doing.color_id == GCColour.TOMATO.value:
+                if currently_doing[1].color_id == GCColour.TOMATO.value:
                     # send notification
 
-                    self.notify.send(f"Your current task ends in 5 minutes. If you have completed it, change it to green now.")
+                    self.notify.notify((currently_doing[1].event_id, starting_time.isoformat()), f"Your current task ends in {notify_before_warning} minutes. If you have completed it, change it to green now.")
         
-        # now check the task list timings against the uploaded ones
+        # now check the task list timings against the uploaded ones, and only touch what changed
 
-        deleted_events = []
-        for task1, event in self.get_uploaded_tasks(False):
-            if currently_doing is not None and task1 == currently_doing[0]:
-                continue
-
-            i = 0
-            found = False
-            for time, task2 in task_list:
-                # Only if the tasks are exactly equivalent and the uploaded event matches task2 will we skip uploading this
-                # In that case remove this item from task list, and do not add it to be deleted
+        with self.metrics.phase("reconcile"):
+            changes = self.reconcile(task_list, currently_doing)
 
-                if task1 == task2 and task2.name == event.summary and task2.length == (event.end - event.start) and task2.desc + tag == event.description and time == event.start:
-                    task_list.pop(i)
+        for event_id in changes.forget:
+            self.uploaded_events.pop(event_id)
+            self.event_lengths.pop(event_id, None)
 
-                    # match has been found
-                    found = True
-                    break
-                
-                i += 1
-            
-            if found is False:
-                deleted_events.append(event.event_id)
+        mutations = [Mutation("delete", event_id) for event_id in changes.delete]
         
-        # now delete all the events that didn't match
+        for time, task, event in changes.update:
+            # move the existing event instead of deleting it and making a new one, so the event id stays the same
+            event.start = time
+            event.end = time + task.length
+            event.summary = task.name
+            event.description = task.desc + tag
+
+            mutations.append(Mutation("update", event, task_of(task)))
+        
+        # and upload the tasks which don't have an event yet
 
-        for event_id in deleted_events:
-            self.link.delete_event(event_id)
+        mutations.extend(self.create_mutations(changes.create))
 
-            # remove these uploaded events from the uploaded events list as well
+        with self.metrics.phase("mutations"):
+            self.apply_mutations(mutations) # all at once, only what succeeded gets saved below
 
-            i=0
-            for eid, task in self.uploaded_events:
-                if eid == event_id:
-                    self.uploaded_events.pop(i)
-                    continue # i would be incremented but then the list length shortens
+        with self.metrics.phase("save"):
+            self.save_events()
+            self.save_snapshot()
 
-                i+=1
-        
-        # now upload task list
+        # the snapshot doesn't know about the changes made above
+        self.invalidate_managed_events()
 
-        self.upload_task_list(task_list)
+        # remember the plan, needs_reload() works out when it next matters from it
 
-        self.save_events()
+        self.task_list = task_list
+        self.currently_doing = currently_doing
+
+        self.metrics.inc("reloads_total")
+        self.update_gauges()
+
+        if self.settings.log_ticks:
+            print(json.dumps({
+                "time": self.last_reload.isoformat(),
+                "phases": self.metrics.tick,
+                "api_calls": self.metrics.total("api_calls_total") - calls,
+                "changes": {"keep": len(changes.keep), "update": len(changes.update), "create": len(changes.create), "delete": len(changes.delete)},
+                "queue_depth": len(self.tasks_by_due),
+                "pending_tasks": len(self.tasks_pending),
+                "events": len(self.events),
+            }), flush=True)
 
         # done!
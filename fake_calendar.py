@@ -0,0 +1,235 @@
+"""
+An in-memory stand-in for gcsa's GoogleCalendar, so Calendar can be run (and measured) without talking to Google.
+
+It covers the parts classes.py uses: get_events, get_event, add_event, update_event, delete_event, iterating over the calendar, and
+service.events().list() with sync tokens and updatedMin. Every call is counted in calls, and can be slowed down by latency seconds
+to stand in for the round trip.
+"""
+
+from collections import Counter
+from copy import copy
+from datetime import datetime
+import itertools
+import json
+import threading
+import time
+
+import httplib2
+from googleapiclient.errors import HttpError
+from gcsa.serializers.event_serializer import EventSerializer
+
+def http_error(status, reason=None):
+    content = b""
+    if reason is not None:
+        content = json.dumps({"error": {"code": status, "errors": [{"reason": reason}]}}).encode("utf-8")
+
+    return HttpError(httplib2.Response({"status": status}), content)
+
+def overlaps(event, time_min, time_max):
+    if time_min is not None and event.end <= time_min:
+        return False
+
+    if time_max is not None and event.start >= time_max:
+        return False
+
+    return True
+
+class FakeGoogleCalendar:
+    def __init__(self, calendar_id="fake", latency=0.0, events=()):
+        self.calendar_id = calendar_id
+        self.latency = latency
+
+        self.lock = threading.Lock()
+        self.calls = Counter() # operation: number of calls
+
+        self.events = {} # event_id: Event
+        self.updated = {} # event_id: when it last changed
+        self.changes = [] # list of event ids in the order they changed, a sync token is an index into this
+        self.token_floor = 0 # sync tokens older than this have expired
+        self.failures = [] # Tuple(error, whether the call goes through first) for the next calls, see fail_next
+
+        self.ids = itertools.count()
+        self.service = FakeService(self)
+
+        for event in events:
+            self.put(event)
+
+    def call(self, operation):
+        """
+        Counts a call, and raises if it should fail before going through. Returns the error to raise once it has gone through, if
+        there is one.
+        """
+        with self.lock:
+            self.calls[operation] += 1
+            failure = self.failures.pop(0) if len(self.failures) > 0 else None
+
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+        if failure is not None:
+            error, applied = failure
+
+            if not applied:
+                raise error
+
+            return error
+
+        return None
+
+    # helpers for setting up a scenario, these don't count as calls
+
+    def put(self, event):
+        """
+        Adds or replaces an event, as if someone else had changed the calendar. Returns the stored copy.
+        """
+        with self.lock:
+            event = copy(event)
+
+            if event.event_id is None:
+                event.event_id = f"{self.calendar_id}-{next(self.ids)}"
+
+            self.events[event.event_id] = event
+            self.updated[event.event_id] = datetime.now().astimezone()
+            self.changes.append(event.event_id)
+
+            return copy(event)
+
+    def remove(self, event_id):
+        with self.lock:
+            if self.events.pop(event_id, None) is None:
+                raise http_error(410)
+
+            self.updated[event_id] = datetime.now().astimezone()
+            self.changes.append(event_id)
+
+    def fail_next(self, status, count=1, reason=None, applied=False):
+        """
+        Makes the next count calls fail with an HttpError, e.g. 429 or 403 with reason "rateLimitExceeded" for a rate limit. With
+        applied, writes still go through before failing, like a 5xx google sends after it has already made the change.
+        """
+        with self.lock:
+            self.failures.extend((http_error(status, reason), applied) for _ in range(count))
+
+    def expire_tokens(self):
+        """
+        Makes every sync token handed out so far invalid, like google does every so often.
+        """
+        with self.lock:
+            self.token_floor = len(self.changes)
+
+    # the GoogleCalendar surface
+
+    def get_events(self, time_min=None, time_max=None, order_by=None, timezone=None, single_events=False, query=None, calendar_id=None, **kwargs):
+        self.call("get_events")
+
+        with self.lock:
+            events = [copy(event) for event in self.events.values() if overlaps(event, time_min, time_max)]
+
+        return iter(sorted(events))
+
+    def __iter__(self):
+        return self.get_events()
+
+    def get_event(self, event_id, calendar_id=None, **kwargs):
+        self.call("get_event")
+
+        with self.lock:
+            event = self.events.get(event_id)
+
+        if event is None:
+            raise http_error(404)
+
+        return copy(event)
+
+    def add_event(self, event, **kwargs):
+        late = self.call("add_event")
+
+        # an id can be chosen by the client, and google won't make a second event with the same one
+        if event.event_id is not None and event.event_id in self.events:
+            raise http_error(409, "duplicate")
+
+        event = self.put(event)
+
+        if late is not None:
+            raise late
+
+        return event
+
+    def update_event(self, event, **kwargs):
+        late = self.call("update_event")
+
+        if event.event_id not in self.events:
+            raise http_error(404)
+
+        event = self.put(event)
+
+        if late is not None:
+            raise late
+
+        return event
+
+    def delete_event(self, event, **kwargs):
+        late = self.call("delete_event")
+
+        event_id = event if isinstance(event, str) else event.event_id
+
+        self.remove(event_id)
+
+        if late is not None:
+            raise late
+
+    def list_raw(self, syncToken=None, timeMin=None, timeMax=None, updatedMin=None, maxResults=None, **kwargs):
+        """
+        What service.events().list(...).execute() gives back, as JSON. Everything comes back on one page.
+        """
+        self.call("list")
+
+        with self.lock:
+            if syncToken is not None:
+                token = int(syncToken)
+                if token < self.token_floor:
+                    raise http_error(410)
+
+                # everything which changed since the token, as it is now
+                changed = dict.fromkeys(self.changes[token:])
+                items = []
+                for event_id in changed:
+                    event = self.events.get(event_id)
+                    if event is None:
+                        items.append({"id": event_id, "status": "cancelled"})
+                    else:
+                        items.append(EventSerializer.to_json(event))
+            elif updatedMin is not None:
+                since = datetime.fromisoformat(updatedMin)
+                items = [{"id": event_id} for event_id, updated in self.updated.items() if updated > since]
+            else:
+                time_min = datetime.fromisoformat(timeMin) if timeMin is not None else None
+                time_max = datetime.fromisoformat(timeMax) if timeMax is not None else None
+
+                items = [EventSerializer.to_json(event) for event in sorted(self.events.values()) if overlaps(event, time_min, time_max)]
+
+            if maxResults is not None:
+                items = items[:maxResults]
+
+            return {"items": items, "nextSyncToken": str(len(self.changes))}
+
+class FakeService:
+    """
+    Just enough of the googleapiclient resource for service.events().list(...).execute().
+    """
+    def __init__(self, calendar):
+        self.calendar = calendar
+
+    def events(self):
+        return self
+
+    def list(self, **kwargs):
+        return FakeRequest(self.calendar, kwargs)
+
+class FakeRequest:
+    def __init__(self, calendar, kwargs):
+        self.calendar = calendar
+        self.kwargs = kwargs
+
+    def execute(self):
+        return self.calendar.list_raw(**self.kwargs)
@@ -0,0 +1,99 @@
+"""
+Sends a backlog of tasks to a running server in batches, through /upload/bulk.
+
+The file is either JSON lines (one task object per line) or CSV with a header row, with the fields name, desc, length (minutes), due, and optionally split and min_segment:
+
+    python import_tasks.py backlog.jsonl
+    python import_tasks.py backlog.csv --url http://localhost:5000 --batch-size 500
+    python import_tasks.py backlog.jsonl --tenant alice
+"""
+
+import argparse
+import csv
+import getpass
+import io
+import sys
+
+import requests
+
+def read_batches(f, file_format, batch_size):
+    """
+    Yields the file as Tuple(request body, number of tasks in it) with at most batch_size tasks each, without reading the whole
+    file in at once.
+    """
+    if file_format == "csv":
+        reader = csv.reader(f)
+        header = next(reader, None)
+        if header is None:
+            return
+
+        batch = []
+        for row in reader:
+            batch.append(row)
+
+            if len(batch) == batch_size:
+                yield write_csv(header, batch), len(batch)
+                batch = []
+
+        if len(batch) > 0:
+            yield write_csv(header, batch), len(batch)
+    else:
+        batch = []
+        for line in f:
+            if line.strip() == "":
+                continue
+
+            batch.append(line.rstrip("\n"))
+
+            if len(batch) == batch_size:
+                yield "\n".join(batch), len(batch)
+                batch = []
+
+        if len(batch) > 0:
+            yield "\n".join(batch), len(batch)
+
+def write_csv(header, rows):
+    out = io.StringIO()
+
+    writer = csv.writer(out)
+    writer.writerow(header)
+    writer.writerows(rows)
+
+    return out.getvalue()
+
+def main():
+    parser = argparse.ArgumentParser(description="Import tasks into the calendar in bulk.")
+    parser.add_argument("file", help="a .jsonl or .csv file of tasks")
+    parser.add_argument("--url", default="http://127.0.0.1:5000", help="where the server is running")
+    parser.add_argument("--tenant", help="whose calendar the tasks go in, if the server has more than one (see tenants.py)")
+    parser.add_argument("--format", choices=["jsonl", "csv"], help="defaults to the file's extension")
+    parser.add_argument("--batch-size", type=int, default=200, help="tasks sent per request")
+    args = parser.parse_args()
+
+    file_format = args.format or ("csv" if args.file.endswith(".csv") else "jsonl")
+    content_type = "text/csv" if file_format == "csv" else "application/jsonl"
+
+    password = getpass.getpass("Password: ")
+
+    session = requests.Session() # keep the connection open between batches
+    session.headers.update({"X-Password": password, "Content-Type": content_type})
+
+    url = args.url.rstrip("/")
+    if args.tenant is not None:
+        url += f"/t/{args.tenant}"
+
+    sent = 0
+
+    with open(args.file, "r", newline="" if file_format == "csv" else None) as f:
+        for body, count in read_batches(f, file_format, args.batch_size):
+            r = session.post(url + "/upload/bulk", data=body.encode("utf-8"), timeout=30)
+
+            if r.status_code != 200:
+                print(f"Batch after {sent} tasks was rejected ({r.status_code}): {r.text}")
+                sys.exit(1)
+
+            sent += count
+            print(f"Sent {sent} tasks")
+
+if __name__ == "__main__":
+    main()
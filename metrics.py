@@ -0,0 +1,80 @@
+from contextlib import contextmanager
+import threading
+from time import perf_counter
+
+class Metrics:
+    """
+    Counters, gauges and phase timers for the refresh loop, which can be rendered in the Prometheus text format for /metrics.
+
+    Every metric name gets prefix_ in front of it, and labels are passed as keyword arguments, e.g. inc("api_calls_total", operation="get_event").
+    """
+    def __init__(self, prefix="calendar"):
+        self.prefix = prefix
+        self.lock = threading.Lock()
+
+        self.counters = {} # name: {labels: value}
+        self.gauges = {} # name: {labels: value}
+
+        self.tick = {} # phase: seconds, for the reload which is running (or last ran)
+
+    def inc(self, name, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+
+        with self.lock:
+            values = self.counters.setdefault(name, {})
+            values[key] = values.get(key, 0) + amount
+
+    def set(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+
+        with self.lock:
+            self.gauges.setdefault(name, {})[key] = value
+
+    def total(self, name):
+        """
+        A counter added up over all of its labels.
+        """
+        with self.lock:
+            return sum(self.counters.get(name, {}).values())
+
+    def start_tick(self):
+        self.tick = {}
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Times the block as one phase of a reload.
+        """
+        start = perf_counter()
+
+        try:
+            yield
+        finally:
+            seconds = perf_counter() - start
+
+            self.tick[name] = self.tick.get(name, 0) + seconds # a phase can run more than once in a reload
+
+            self.inc("phase_seconds_total", seconds, phase=name)
+            self.inc("phase_runs_total", phase=name)
+            self.set("phase_last_seconds", self.tick[name], phase=name)
+
+    def render(self):
+        lines = []
+
+        with self.lock:
+            for kind, metrics in (("counter", self.counters), ("gauge", self.gauges)):
+                for name in sorted(metrics):
+                    full_name = f"{self.prefix}_{name}"
+                    lines.append(f"# TYPE {full_name} {kind}")
+
+                    for labels, value in sorted(metrics[name].items()):
+                        if len(labels) > 0:
+                            label_text = ",".join(f'{key}="{escape(value)}"' for key, value in labels)
+                            lines.append(f"{full_name}{{{label_text}}} {value}")
+                        else:
+                            lines.append(f"{full_name} {value}")
+
+        return "\n".join(lines) + "\n"
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
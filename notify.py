@@ -0,0 +1,144 @@
+import heapq
+import itertools
+import random
+import threading
+import time
+
+class NotifyRun:
+    """
+    Sends notifications to a notify.run channel. The connection is kept open between sends, and every post has a timeout so a slow
+    endpoint can't hang whoever is sending.
+    """
+    def __init__(self, url, timeout=5):
+        self.url = url
+        self.timeout = timeout
+
+        self.session = None # made on the notify thread the first time something is sent
+
+    def send(self, content):
+        if self.session is None:
+            import requests # only needed once there's something to send, it's slow to import
+            self.session = requests.Session()
+
+        r = self.session.post(url=self.url, data=content.encode("utf-8"), timeout=self.timeout)
+        r.raise_for_status()
+
+class MemorySink:
+    """
+    Keeps notifications in a list instead of sending them anywhere, for trying things out locally.
+    """
+    def __init__(self):
+        self.messages = []
+
+    def send(self, content):
+        print(f"Notification: {content}")
+        self.messages.append(content)
+
+class Notifier:
+    """
+    Sends notifications on background threads, so the refresh loop never waits for the network.
+
+    Notifications go through a Channel, which has the sink (anything with a send(content) method) they end up at. Any number of
+    channels can share one Notifier and its worker threads, e.g. one for every tenant, and a Notifier made with a sink has a channel
+    of its own for notify(). A send which raises is retried with exponential backoff (and some jitter) up to the channel's retries
+    more times.
+
+    Sends wait in a queue ordered by when they're due. A failed send goes back in for later rather than the thread sleeping on it,
+    so one channel with an endpoint that's down only ever holds a thread for one try at a time.
+    """
+    def __init__(self, sink=None, retries=3, backoff=1.0, metrics=None, workers=2):
+        self.retries = retries # for channels which don't say
+        self.backoff = backoff
+
+        self.condition = threading.Condition()
+        self.queue = [] # heap of Tuple(due, entry, channel, content, attempt), due in monotonic seconds
+        self.entries = itertools.count() # first come first served when they're due at the same time
+
+        self.default = self.channel(sink, metrics) if sink is not None else None
+
+        self.threads = [threading.Thread(target=self.run, name=f"notify-{i}", daemon=True) for i in range(workers)]
+
+        for thread in self.threads:
+            thread.start()
+
+    def channel(self, sink, metrics=None, retries=None):
+        return Channel(self, sink, metrics, retries if retries is not None else self.retries)
+
+    def notify(self, key, content):
+        return self.default.notify(key, content)
+
+    def put(self, channel, content, attempt=0, delay=0):
+        with self.condition:
+            heapq.heappush(self.queue, (time.monotonic() + delay, next(self.entries), channel, content, attempt))
+            self.condition.notify()
+
+    def next_due(self):
+        """
+        Waits for the send which is due next and takes it out of the queue.
+        """
+        with self.condition:
+            while True:
+                if len(self.queue) == 0:
+                    self.condition.wait()
+                    continue
+
+                wait = self.queue[0][0] - time.monotonic()
+
+                if wait <= 0:
+                    return heapq.heappop(self.queue)[2:]
+
+                self.condition.wait(wait)
+
+    def run(self):
+        while True:
+            channel, content, attempt = self.next_due()
+
+            try:
+                channel.sink.send(content)
+                channel.count("notifications_sent_total")
+            except Exception as e:
+                if attempt == channel.retries:
+                    print(f"Couldn't send a notification after {attempt + 1} tries: {e}")
+                    channel.count("notifications_failed_total")
+                else:
+                    self.put(channel, content, attempt + 1, self.backoff * 2 ** attempt * random.uniform(0.5, 1.5))
+
+class Channel:
+    """
+    Notifications for one sink, sent on a Notifier's threads and counted in metrics (a Metrics) if it's given. A send which fails is
+    tried up to retries more times.
+
+    Every notification has a key, and a key is only ever queued once per channel, so a warning which is checked for on every reload
+    still only goes out once.
+    """
+    def __init__(self, notifier, sink, metrics=None, retries=3):
+        self.notifier = notifier
+        self.sink = sink
+        self.metrics = metrics
+        self.retries = retries
+
+        self.lock = threading.Lock()
+        self.keys = {} # key: when it was queued, so old keys can be let go of
+
+    def notify(self, key, content):
+        """
+        Queues content to be sent, unless something with the same key has been already. Returns whether it was queued.
+        """
+        now = time.monotonic()
+
+        with self.lock:
+            if key in self.keys:
+                return False
+
+            self.keys[key] = now
+
+            # nothing gets checked for again after a day, so keys older than that can go
+            for old in [old for old, queued in self.keys.items() if now - queued > 24 * 60 * 60]:
+                self.keys.pop(old)
+
+        self.notifier.put(self, content)
+        return True
+
+    def count(self, name):
+        if self.metrics is not None:
+            self.metrics.inc(name)
@@ -0,0 +1,247 @@
+"""
+Local search over the order tasks are laid out in, for when the earliest deadline first plan still leaves tasks late.
+
+A layout is an order of the tasks plus how far log_off is pushed back (in steps of 30 minutes). It's turned into times the same way
+organise_calendar does it, by putting each task in turn into the earliest free time it fits in, so every layout is valid. Layouts are
+scored on lateness, how many pieces split tasks get cut into and how much time is spent working past the real log_off, and the
+search keeps moving tasks earlier or swapping them while the score goes down.
+
+The searches run in worker processes (see process_pool) so they don't hold the GIL while the web server and the refresh thread are
+running, and they stop after a time budget. Nothing in here touches google.
+"""
+
+import multiprocessing
+import random
+from concurrent.futures import ProcessPoolExecutor, wait
+from datetime import datetime, timedelta
+from time import monotonic
+
+from scheduling import GapPool, free_gaps, active_windows, window_length, to_minutes, from_minutes, minute
+
+# what a minute of each is worth in the score
+lateness_weight = 1.0
+overrun_weight = 0.5 # working a bit later is better than handing something in late
+fragment_weight = 30.0 # every extra piece a split task is cut into costs about half an hour of getting back into it
+unplaced_weight = 10 ** 9
+extension_weight = 0.01 # only there so the smallest extension which does the job wins
+
+def extend(log_off, extension):
+    return (datetime.combine(datetime(2000, 1, 1), log_off) + extension).time()
+
+def extensions(log_on, log_off, most):
+    """
+    How far log_off can be pushed back, in steps of 30 minutes up to most, without the active period covering the whole day.
+    """
+    result = [timedelta(0)]
+    length = window_length(log_on, log_off)
+
+    extension = timedelta(minutes=30)
+    while extension <= most and window_length(log_on, extend(log_off, extension)) == length + extension:
+        result.append(extension)
+        extension += timedelta(minutes=30)
+
+    return result
+
+class Problem:
+    """
+    Everything a layout depends on, as plain values so it can be sent to another process. tasks is a list of Tuple(length, due,
+    split, min_segment) in due order, all in minutes (due is an epoch minute, or None), busy is an IntervalIndex and step is in minutes.
+    """
+    def __init__(self, log_on, log_off, working_time, busy, tasks, step, extensions):
+        self.log_on = log_on
+        self.log_off = log_off
+        self.working_time = working_time
+        self.busy = busy
+        self.tasks = tasks
+        self.step = step
+        self.extensions = extensions
+
+class Layout:
+    """
+    The tasks of a Problem placed in the order given, with log_off pushed back by extension. placements has the list of Tuple(start,
+    length) each task was given, in the same order as order.
+
+    The pool's log means changing the order from position k only has to place the tasks from k onwards again.
+    """
+    def __init__(self, problem, order, extension):
+        self.problem = problem
+        self.order = list(order)
+        self.extension = extension
+
+        self.log_off = extend(problem.log_off, extension)
+        self.longest = window_length(problem.log_on, self.log_off) // minute
+
+        gaps = free_gaps(problem.busy, problem.log_on, self.log_off, problem.working_time)
+        self.pool = GapPool(gaps, to_minutes(problem.working_time), problem.step, self.longest)
+
+        self.marks = [] # the pool's log length before each task was placed
+        self.placements = []
+
+        self.place_from(0)
+
+    def place_from(self, k, order=None):
+        """
+        Places everything from position k onwards again, in order if it's given.
+        """
+        if order is not None:
+            self.order = order
+
+        if k < len(self.marks):
+            self.pool.rollback(self.marks[k])
+
+        del self.marks[k:], self.placements[k:]
+
+        for index in self.order[k:]:
+            length, due, split, minimum = self.problem.tasks[index]
+            self.marks.append(len(self.pool.log))
+
+            pieces = []
+            if split:
+                pieces = self.pool.place_split(length, minimum)
+            elif length <= self.longest:
+                start = self.pool.place(length)
+
+                if start is not None:
+                    pieces = [(start, length)]
+
+            self.placements.append(pieces)
+
+    def overrun(self, start, length):
+        """
+        How many minutes of [start, start + length) are outside the real active periods.
+        """
+        end = start + length
+        inside = 0
+
+        for window_start, window_end in active_windows(self.problem.log_on, self.problem.log_off, from_minutes(start, self.problem.working_time.tzinfo)):
+            window_start, window_end = to_minutes(window_start), to_minutes(window_end)
+            if window_start >= end:
+                break
+
+            inside += max(0, min(end, window_end) - max(start, window_start))
+
+        return length - inside
+
+    def score(self):
+        total = extension_weight * (self.extension / minute)
+
+        for index, pieces in zip(self.order, self.placements):
+            length, due, split, minimum = self.problem.tasks[index]
+
+            if len(pieces) == 0:
+                total += unplaced_weight
+                continue
+
+            total += fragment_weight * (len(pieces) - 1)
+
+            finish = max(start + piece for start, piece in pieces)
+            if due is not None and finish > due:
+                total += lateness_weight * (finish - due)
+
+            if self.extension > timedelta(0):
+                total += overrun_weight * sum(self.overrun(start, piece) for start, piece in pieces)
+
+        return total
+
+    def late(self):
+        """
+        The positions in order of the tasks which finish after they're due.
+        """
+        positions = []
+
+        for position, (index, pieces) in enumerate(zip(self.order, self.placements)):
+            due = self.problem.tasks[index][1]
+
+            if due is not None and len(pieces) > 0 and max(start + piece for start, piece in pieces) > due:
+                positions.append(position)
+
+        return positions
+
+def search(problem, order, extension, seed, budget):
+    """
+    Hill climbs from the layout (order, extension) for budget seconds. Returns the best one found as Tuple(score, order, extension).
+
+    A step either moves a late task to somewhere earlier in the order, swaps two tasks, or tries another extension, and is kept if
+    the score doesn't go up.
+    """
+    rng = random.Random(seed)
+    deadline = monotonic() + budget
+
+    layout = Layout(problem, order, extension)
+    score = layout.score()
+    best = (score, list(layout.order), extension)
+
+    n = len(order)
+    if n < 2:
+        return best
+
+    while monotonic() < deadline:
+        move = rng.random()
+
+        if move < 0.1 and len(problem.extensions) > 1:
+            candidate = Layout(problem, layout.order, rng.choice(problem.extensions))
+            candidate_score = candidate.score()
+
+            if candidate_score <= score:
+                layout, score = candidate, candidate_score
+        else:
+            late = layout.late()
+
+            if move < 0.6 and len(late) > 0:
+                j = rng.choice(late)
+                if j == 0:
+                    continue
+
+                i = rng.randrange(j)
+                new_order = layout.order[:i] + [layout.order[j]] + layout.order[i:j] + layout.order[j + 1:]
+            else:
+                i, j = sorted(rng.sample(range(n), 2))
+                new_order = list(layout.order)
+                new_order[i], new_order[j] = new_order[j], new_order[i]
+
+            old_order = layout.order
+            layout.place_from(i, new_order)
+            candidate_score = layout.score()
+
+            if candidate_score <= score:
+                score = candidate_score
+            else:
+                layout.place_from(i, old_order) # put it back
+
+        if score < best[0]:
+            best = (score, list(layout.order), layout.extension)
+
+    return best
+
+def process_pool(workers):
+    """
+    A process pool for optimise. The workers come from a forkserver with this module already imported, not forked from the server:
+    forking a process with other threads running can copy a lock one of them is holding, and deadlock the child. The workers only
+    need this module and scheduling.py. Where there's no forkserver (windows) they're spawned.
+    """
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context("forkserver")
+        context.set_forkserver_preload(["optimiser"])
+    else:
+        context = multiprocessing.get_context("spawn")
+
+    return ProcessPoolExecutor(max_workers=workers, mp_context=context)
+
+def optimise(pool, problem, order, extension, budget, workers):
+    """
+    Runs workers searches from (order, extension) at once on the process pool pool, each with its own seed. Returns the best
+    Tuple(score, order, extension) found by any of them, or None if none of them came back in time.
+    """
+    futures = [pool.submit(search, problem, order, extension, seed, budget) for seed in range(workers)]
+
+    done, not_done = wait(futures, timeout=budget + 5) # leave some time for sending the problem over and the answer back
+
+    for future in not_done:
+        future.cancel()
+
+    results = [future.result() for future in done if future.exception() is None]
+
+    if len(results) == 0:
+        return None
+
+    return min(results, key=lambda result: result[0])
@@ -0,0 +1,107 @@
+import json
+import random
+import threading
+from time import monotonic, sleep
+
+from googleapiclient.errors import HttpError
+
+# 403s with one of these reasons are google saying slow down, not that we aren't allowed
+rate_limit_reasons = ["rateLimitExceeded", "userRateLimitExceeded"]
+
+class TokenBucket:
+    """
+    Lets calls through at rate a second on average, with bursts of up to burst at once. Shared by every link so all of them together
+    stay under the quota.
+    """
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+
+        self.tokens = burst
+        self.last = monotonic()
+
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Takes a token, waiting until there is one. Returns how many seconds it waited.
+        """
+        waited = 0.0
+
+        while True:
+            with self.lock:
+                now = monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+
+                wait = (1 - self.tokens) / self.rate
+
+            sleep(wait)
+            waited += wait
+
+def reason(error):
+    try:
+        return json.loads(error.content)["error"]["errors"][0]["reason"]
+    except (ValueError, KeyError, IndexError, TypeError):
+        return None
+
+def retry_delay(error, attempt, base, cap=32.0):
+    """
+    How long to wait before trying again after error on attempt (counting from 0), or None if it isn't worth trying again.
+
+    Rate limits (429, or 403 with a rate limit reason) and server errors back off exponentially from base seconds, with full jitter
+    so a burst of failed calls doesn't all come back at once. A Retry-After header from google wins if there is one.
+    """
+    if not isinstance(error, HttpError):
+        return None
+
+    status = error.resp.status
+
+    if not (status == 429 or status >= 500 or (status == 403 and reason(error) in rate_limit_reasons)):
+        return None
+
+    retry_after = error.resp.get("retry-after")
+    if retry_after is not None and retry_after.isdigit():
+        return float(retry_after)
+
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+class ReadCache:
+    """
+    Results of reads from one calendar, kept for ttl seconds. Anything written to the calendar clears it.
+    """
+    missing = object()
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+
+        self.entries = {} # key: Tuple(when it expires, value)
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+
+            if entry is None:
+                return self.missing
+
+            if entry[0] <= monotonic():
+                self.entries.pop(key)
+                return self.missing
+
+            return entry[1]
+
+    def put(self, key, value):
+        if self.ttl <= 0:
+            return
+
+        with self.lock:
+            self.entries[key] = (monotonic() + self.ttl, value)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
@@ -0,0 +1,383 @@
+from array import array
+from bisect import bisect_right
+from datetime import datetime, timedelta
+
+# everything in here works on plain datetimes (or minutes since the epoch) so it can be used without a connection to google
+
+def contextualise(time, date):
+    """
+    Adds a date to a time, allowing for the time to be compared against the global timeline
+    """
+    return date.replace(hour=time.hour,minute=time.minute,second=time.second)
+
+minute = timedelta(minutes=1)
+
+def align(moment, anchor, step):
+    """
+    Rounds moment up onto the grid of anchor + n * step.
+    """
+    if moment <= anchor:
+        return anchor
+
+    return anchor - ((anchor - moment) // step) * step
+
+def window_length(log_on, log_off):
+    """
+    How long a single active period lasts. If log_off is before log_on, the period runs overnight.
+    """
+    day = datetime(2000, 1, 1)
+
+    start = contextualise(log_on, day)
+    end = contextualise(log_off, day)
+
+    if end <= start:
+        end += timedelta(days=1)
+
+    return end - start
+
+def active_windows(log_on, log_off, after):
+    """
+    Yields every active period as Tuple(start, end), from the one which contains (or comes after) the datetime after, onwards forever.
+    """
+    # when the period runs overnight, yesterday's period might still be going
+    day = after.replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=1)
+
+    while True:
+        start = contextualise(log_on, day)
+        end = contextualise(log_off, day)
+
+        if end <= start:
+            end += timedelta(days=1)
+
+        if end > after:
+            yield max(start, after), end
+
+        day += timedelta(days=1)
+
+def to_minutes(moment, up=False):
+    """
+    A datetime as a whole number of minutes since the epoch, rounded down (or up).
+    """
+    seconds = moment.timestamp()
+
+    return -int(-seconds // 60) if up else int(seconds // 60)
+
+def from_minutes(minutes, tz):
+    return datetime.fromtimestamp(minutes * 60, tz)
+
+class IntervalIndex:
+    """
+    Busy time kept as two sorted columns of epoch minutes (the starts and ends of non-overlapping intervals), so the interval
+    overlapping a slot can be found with a binary search over plain integers instead of comparing timezone aware datetimes.
+
+    The columns are arrays of 64 bit integers, 16 bytes an interval.
+    """
+    def __init__(self, intervals=()):
+        self.starts = array("q")
+        self.ends = array("q")
+
+        for start, end in sorted(intervals):
+            if self.ends and start <= self.ends[-1]:
+                # overlaps or touches the previous interval, so merge the two
+                if end > self.ends[-1]:
+                    self.ends[-1] = end
+            else:
+                self.starts.append(start)
+                self.ends.append(end)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def first_overlap(self, start, end):
+        """
+        Returns the first busy interval as Tuple(start, end) which overlaps [start, end), or None if all of that time is free.
+
+        Touching intervals don't count as overlapping.
+        """
+        i = bisect_right(self.ends, start) # the first interval that ends after start
+
+        if i < len(self.starts) and self.starts[i] < end:
+            return self.starts[i], self.ends[i]
+
+        return None
+
+    def first_difference(self, other):
+        """
+        The earliest minute where the busy time in other isn't the same as in this index, or None if they're the same. It's the
+        start of the first interval which differs, so everything before it is free or busy in both.
+        """
+        if self.starts == other.starts and self.ends == other.ends:
+            return None
+
+        for i, (start, end) in enumerate(zip(self.starts, self.ends)):
+            if i >= len(other.starts) or other.starts[i] != start or other.ends[i] != end:
+                return min(start, other.starts[i]) if i < len(other.starts) else start
+
+        return other.starts[len(self.starts)]
+
+def free_gaps(busy, log_on, log_off, after):
+    """
+    Yields the free time after the datetime after as a stream of Tuple(start, end) in epoch minutes, by sweeping the active periods
+    against the busy intervals in the IntervalIndex busy.
+    """
+    for window_start, window_end in active_windows(log_on, log_off, after):
+        cursor = to_minutes(window_start, up=True)
+        window_end = to_minutes(window_end)
+
+        i = bisect_right(busy.ends, cursor) # skip everything which has already finished
+
+        while i < len(busy.starts) and busy.starts[i] < window_end:
+            if busy.starts[i] > cursor:
+                yield cursor, busy.starts[i]
+
+            cursor = max(cursor, busy.ends[i])
+            i += 1
+
+        if cursor < window_end:
+            yield cursor, window_end
+
+class GapPool:
+    """
+    Free time pulled lazily out of a free_gaps stream, for handing out to tasks on a grid of anchor + n * step. Everything in here is
+    in minutes: times are epoch minutes and lengths are numbers of minutes.
+
+    A max segment tree over how much grid aligned time each gap has left means the earliest gap which can hold a task is found in
+    O(log n), and a gap that was skipped because it was too short for one task is still there for a shorter task later on.
+    """
+    def __init__(self, gaps, anchor, step, longest):
+        self.gaps = gaps
+        self.anchor = anchor
+        self.step = step
+        self.longest = longest # the longest a gap can possibly be, i.e. a whole active period with nothing in it
+
+        self.starts = [] # where the free time left in each gap starts, always on the grid
+        self.ends = []
+
+        self.capacity = 1
+        self.tree = [0] * 2 # 1 indexed, the leaves start at self.capacity
+
+        self.log = [] # Tuple(gap, where it started) for every take, so placements can be rolled back
+
+    def set(self, i, value):
+        j = i + self.capacity
+        self.tree[j] = value
+
+        j //= 2
+        while j > 0:
+            self.tree[j] = max(self.tree[2 * j], self.tree[2 * j + 1])
+            j //= 2
+
+    def grow(self):
+        leaves = self.tree[self.capacity:self.capacity + len(self.starts)]
+
+        self.capacity *= 2
+        self.tree = [0] * (2 * self.capacity)
+        self.tree[self.capacity:self.capacity + len(leaves)] = leaves
+
+        for j in range(self.capacity - 1, 0, -1):
+            self.tree[j] = max(self.tree[2 * j], self.tree[2 * j + 1])
+
+    def pull(self):
+        """
+        Takes the next gap off the stream. Returns how long it was before being aligned to the grid.
+        """
+        gap_start, gap_end = next(self.gaps)
+
+        if len(self.starts) == self.capacity:
+            self.grow()
+
+        start = align(gap_start, self.anchor, self.step)
+
+        self.starts.append(start)
+        self.ends.append(gap_end)
+        self.set(len(self.starts) - 1, max(0, gap_end - start))
+
+        return gap_end - gap_start
+
+    def find(self, length):
+        """
+        The index of the earliest gap with at least length of time left in it, pulling more gaps off the stream as needed. None if
+        nothing could ever hold it.
+        """
+        while self.tree[1] < length:
+            if self.pull() >= self.longest and self.tree[1] < length:
+                # a completely free active period couldn't fit it, so nothing further on will either
+                return None
+
+        # walk down the tree, going left whenever the left half has room
+        j = 1
+        while j < self.capacity:
+            j = 2 * j if self.tree[2 * j] >= length else 2 * j + 1
+
+        return j - self.capacity
+
+    def take(self, i, length):
+        """
+        Takes length of time off the front of gap i, and returns when that time starts.
+        """
+        start = self.starts[i]
+        self.log.append((i, start))
+
+        self.starts[i] = align(start + length, self.anchor, self.step)
+        self.set(i, max(0, self.ends[i] - self.starts[i]))
+
+        return start
+
+    def rollback(self, mark):
+        """
+        Gives back everything taken since the log was mark long, newest first.
+        """
+        while len(self.log) > mark:
+            i, start = self.log.pop()
+
+            self.starts[i] = start
+            self.set(i, max(0, self.ends[i] - start))
+
+    def reserve(self, start, length):
+        """
+        Takes length of time starting exactly at start, which has to be the front of a gap, i.e. where place would have put it.
+        Returns False (and takes nothing) if that time isn't free at the front of a gap.
+        """
+        while len(self.ends) == 0 or self.ends[-1] <= start:
+            self.pull()
+
+        i = bisect_right(self.ends, start)
+
+        if self.starts[i] != start or self.tree[i + self.capacity] < length:
+            return False
+
+        self.take(i, length)
+        return True
+
+    def place(self, length):
+        """
+        Takes length of time out of the earliest gap with room for it, and returns when that time starts. Returns None if nothing
+        could ever hold it.
+        """
+        i = self.find(length)
+
+        if i is None:
+            return None
+
+        return self.take(i, length)
+
+    def place_split(self, length, minimum):
+        """
+        Like place, but the time can be cut up into pieces of at least minimum each, filling the earliest gaps which can hold one.
+        Returns a list of Tuple(start, length), which is empty if it could never all be placed.
+        """
+        minimum = max(1, minimum) # with a minimum of 0 a full gap would hand out empty pieces forever
+
+        pieces = []
+        remaining = length
+        mark = len(self.log)
+
+        while remaining > 0:
+            # anything under two minimums can't be cut without one of the pieces being too short, so it goes in whole
+            need = remaining if remaining < 2 * minimum else minimum
+
+            i = self.find(need)
+            if i is None:
+                # the rest can never be placed, so give back what was taken and don't place any of it
+                self.rollback(mark)
+                return []
+
+            piece = min(remaining, self.tree[i + self.capacity])
+
+            if 0 < remaining - piece < minimum:
+                piece = remaining - minimum # leave enough over for the last piece
+
+            pieces.append((self.take(i, piece), piece))
+            remaining -= piece
+
+        return pieces
+
+def infeasible_tasks(tasks, gaps):
+    """
+    Takes Tuple(task, length still to do) in due date order and a free_gaps stream, and returns the tasks which would finish after
+    their due date even if
+    every task could be cut up to fill any gap, i.e. earliest deadline first with preemption. No layout can get those in on time
+    without making another task late instead.
+
+    This is one pass over the tasks and the gaps up until the last due date.
+    """
+    infeasible = []
+
+    work = 0 # minutes needed by every task due so far
+    capacity = 0 # free minutes in the gaps which finish before the current due date
+    gap_start, gap_end = next(gaps)
+
+    for task, length in tasks:
+        if task.due is None:
+            continue
+
+        work += length // minute
+        due = to_minutes(task.due)
+
+        while gap_end <= due:
+            capacity += gap_end - gap_start
+            gap_start, gap_end = next(gaps)
+
+        # the gap the due date falls in (or before) counts up until the due date
+        available = capacity + max(0, due - gap_start)
+
+        if work > available:
+            infeasible.append(task)
+
+    return infeasible
+
+class PlanMemo:
+    """
+    The last plan organise_calendar made, kept so the next plan only has to redo the tasks after the first thing which changed.
+
+    For every task (in due order) it remembers what its placement depended on, where the pool's log was before it was placed and
+    what it was given as a list of Tuple(start, item). A task's placement only depends on the tasks before it and on the free time up
+    until it ends, so everything before the first changed task, busy interval or start of the plan can be kept as it was.
+    """
+    def __init__(self, log_on, log_off, working_time, busy, pool):
+        self.log_on = log_on
+        self.log_off = log_off
+        self.working_time = working_time
+        self.busy = busy
+        self.pool = pool
+
+        self.inputs = []
+        self.marks = []
+        self.placements = []
+
+    def add(self, key, placements, mark):
+        self.inputs.append(key)
+        self.marks.append(mark)
+        self.placements.append(placements)
+
+    def common_prefix(self, inputs):
+        """
+        How many tasks at the front of inputs are the same as last time, in the same order. The first item of each key is the task,
+        which is compared by identity.
+        """
+        for k, (old, new) in enumerate(zip(self.inputs, inputs)):
+            if old[0] is not new[0] or old[1:] != new[1:]:
+                return k
+
+        return min(len(self.inputs), len(inputs))
+
+    def truncate(self, k):
+        """
+        Forgets every task from k on, giving their time back to the pool.
+        """
+        if k < len(self.marks):
+            self.pool.rollback(self.marks[k])
+
+        del self.inputs[k:], self.marks[k:], self.placements[k:]
+
+    def valid_prefix(self, k, working_time, changed):
+        """
+        How many of the first k tasks were placed entirely after working_time and before the busy time changed at the epoch minute
+        changed.
+        """
+        for i in range(k):
+            for start, item in self.placements[i]:
+                if start < working_time or (changed is not None and to_minutes(start + item.length, up=True) > changed):
+                    return i
+
+        return k
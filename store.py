@@ -0,0 +1,79 @@
+import json
+import os
+import sqlite3
+import threading
+
+class TaskStore:
+    """
+    Keeps what used to be written to events.json in sqlite (WAL mode), one row per record.
+
+    Records are keyed the same way events.json was: an event_id for every uploaded task, and "not_uploaded" for the list of tasks
+    still waiting to be uploaded. A commit only writes the rows which changed, and happens in a single transaction, so a crash
+    half way through leaves the last commit intact rather than a half written file.
+    """
+    def __init__(self, path="events.db", legacy_path="events.json"):
+        self.path = path
+        self.lock = threading.Lock()
+
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS records (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS snapshots (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self.connection.commit()
+
+        self.committed = dict(self.connection.execute("SELECT key, value FROM records")) # key: json string, what's on disk right now
+        self.snapshots = dict(self.connection.execute("SELECT key, value FROM snapshots"))
+
+        if len(self.committed) == 0 and legacy_path is not None and os.path.isfile(legacy_path):
+            # first run after moving off events.json, bring everything across. the old file is left alone
+            with open(legacy_path, "r") as f:
+                self.commit(json.loads(f.read()))
+
+    def load(self):
+        """
+        Returns everything in the store as a dict in the events.json layout.
+        """
+        return {key: json.loads(value) for key, value in self.committed.items()}
+
+    def commit(self, obj):
+        """
+        Makes the store match obj (a dict in the events.json layout), writing only the records which changed.
+        """
+        records = {key: json.dumps(value, sort_keys=True) for key, value in obj.items()}
+
+        with self.lock:
+            changed = [(key, value) for key, value in records.items() if self.committed.get(key) != value]
+            removed = [(key,) for key in self.committed if key not in records]
+
+            if len(changed) == 0 and len(removed) == 0:
+                return
+
+            with self.connection: # one transaction, rolled back if anything goes wrong
+                self.connection.executemany("INSERT OR REPLACE INTO records (key, value) VALUES (?, ?)", changed)
+                self.connection.executemany("DELETE FROM records WHERE key = ?", removed)
+
+            self.committed = records
+
+    def load_snapshot(self, key):
+        """
+        Returns the snapshot saved under key, or None if there isn't one. Snapshots are kept apart from the records, they're a cache
+        of what google had (e.g. a read calendar's events and sync token) which can be thrown away at any time.
+        """
+        value = self.snapshots.get(key)
+
+        return json.loads(value) if value is not None else None
+
+    def save_snapshot(self, key, obj):
+        value = json.dumps(obj, sort_keys=True)
+
+        with self.lock:
+            if self.snapshots.get(key) == value:
+                return
+
+            with self.connection:
+                self.connection.execute("INSERT OR REPLACE INTO snapshots (key, value) VALUES (?, ?)", (key, value))
+
+            self.snapshots[key] = value
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,262 @@
+"""
+Runs the calendars of more than one person in one process.
+
+config.json can have a "tenants" object of name: config, where each config is laid out like the top level of config.json (log_on,
+log_off, write_calendar, read_calendars, password_hash, ...). Anything a tenant leaves out is taken from the top level, so shared
+things like service_account_file_name or api_rate only have to be given once. Without "tenants" the top level is the only tenant,
+called default, which is how config.json has always looked.
+
+Every tenant's refreshes run on one RefreshPool of refresh_workers threads, and calls to google go through fetch and mutation pools
+which are shared by all of them too, as are the notify_workers threads notifications are sent from, so the number of threads doesn't
+grow with the number of tenants.
+"""
+
+import heapq
+import itertools
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, time
+from time import monotonic
+
+from classes import Calendar, Settings, local_timezone
+from notify import Notifier
+import optimiser
+from quota import TokenBucket
+from store import TaskStore
+
+default_tenant = "default"
+tenant_name = re.compile(r"[A-Za-z0-9_-]+") # they end up in urls and file names
+
+def parse_time(string):
+    index = string.find(":")
+
+    hour = int(string[:index])
+    minute = int(string[index+1:])
+
+    return time(hour=hour,minute=minute)
+
+def tenant_configs(config):
+    """
+    Returns name: config for every tenant in config (all of config.json), with the top level filled in to each of them.
+    """
+    if "tenants" not in config:
+        return {default_tenant: config}
+
+    shared = {key: value for key, value in config.items() if key != "tenants"}
+    configs = {}
+
+    for name, values in config["tenants"].items():
+        if tenant_name.fullmatch(name) is None:
+            raise ValueError(f"Tenant names can only have letters, numbers, - and _ in them, not {name!r}")
+
+        configs[name] = dict(shared)
+        configs[name].update(values)
+
+    return configs
+
+class Tenant:
+    """
+    One person's Calendar, along with when the RefreshPool should next look at it.
+    """
+    def __init__(self, name, config, calendar):
+        self.name = name
+        self.config = config
+        self.calendar = calendar
+
+        self.max_refresh_rate = config.get("max_refresh_rate", 120) # how far checking backs off to when nothing is happening
+        self.interval = calendar.refresh_rate
+
+        # only touched by the RefreshPool, with its lock held
+        self.entry = None # the number of this tenant's entry in the queue, older entries for it are skipped
+        self.running = False
+
+    def refresh(self):
+        """
+        Reloads the calendar if anything needs it. Returns how many seconds until it should be looked at again.
+        """
+        calendar = self.calendar
+
+        try:
+            # the first one always reloads, so the web server is up before anything has been fetched
+            if calendar.needs_reload():
+                calendar.reload_tasks()
+                self.interval = calendar.refresh_rate
+            else:
+                # nothing changed, check less often
+                self.interval = min(self.interval * 2, self.max_refresh_rate)
+        except Exception as e:
+            # e.g. google being unreachable, which shouldn't stop this tenant being refreshed for good
+            print(f"Refresh of {self.name} failed: {e}")
+            calendar.last_reload = None # needs_reload() always says yes until a reload has gone through
+            self.interval = calendar.refresh_rate
+
+        # come back earlier if the plan needs looking at (a task ending, the warning before it)
+        timeout = self.interval
+
+        deadline = calendar.next_deadline()
+        if deadline is not None:
+            timeout = min(timeout, max(0, (deadline - datetime.now(local_timezone)).total_seconds()))
+
+        return timeout
+
+    def __repr__(self):
+        return f"Tenant({self.name})"
+
+class RefreshPool:
+    """
+    Refreshes tenants on a fixed number of threads.
+
+    Tenants wait in a queue ordered by when they're next due (first come first served when that's the same), and a tenant is taken
+    out of the queue while it's being refreshed, so no tenant is refreshed by two threads at once and one with a lot going on can't
+    hold up the others: once it's done it goes in behind every tenant which was due before its next refresh.
+    """
+    def __init__(self, workers):
+        self.condition = threading.Condition()
+        self.queue = [] # heap of Tuple(due, entry, tenant), due in monotonic seconds
+        self.entries = itertools.count()
+        self.closed = False
+
+        self.threads = [threading.Thread(target=self.run, name=f"refresh-{i}") for i in range(workers)]
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+
+    def close(self):
+        """
+        Stops the threads once they've finished the refreshes they're in the middle of.
+        """
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def add(self, tenant):
+        with self.condition:
+            self.schedule(tenant, monotonic())
+
+    def wake(self, tenant):
+        """
+        Moves the tenant's next refresh up to now, e.g. because a task has come in for it. Call it after calendar.wake is set.
+        """
+        with self.condition:
+            # if it's being refreshed, run() sees calendar.wake and puts it straight back in
+            if not tenant.running:
+                self.schedule(tenant, monotonic())
+
+    def schedule(self, tenant, due):
+        # with self.condition held
+        tenant.entry = next(self.entries)
+        heapq.heappush(self.queue, (due, tenant.entry, tenant))
+
+        self.condition.notify()
+
+    def next_due(self):
+        """
+        Waits for the tenant which is due next and takes it out of the queue. None once the pool is closed.
+        """
+        # with self.condition held
+        while not self.closed:
+            while len(self.queue) > 0 and self.queue[0][1] != self.queue[0][2].entry:
+                heapq.heappop(self.queue) # it has been woken since, the newer entry is the one which counts
+
+            if len(self.queue) == 0:
+                self.condition.wait()
+                continue
+
+            wait = self.queue[0][0] - monotonic()
+
+            if wait <= 0:
+                return heapq.heappop(self.queue)[2]
+
+            self.condition.wait(wait)
+
+        return None
+
+    def run(self):
+        while True:
+            with self.condition:
+                tenant = self.next_due()
+
+                if tenant is None:
+                    return
+
+                tenant.running = True
+
+            timeout = 0
+
+            try:
+                timeout = tenant.refresh()
+            finally:
+                with self.condition:
+                    tenant.running = False
+
+                    if tenant.calendar.wake.is_set():
+                        timeout = 0 # something came in while it was being refreshed
+
+                    self.schedule(tenant, monotonic() + timeout)
+
+class TenantRegistry:
+    """
+    Every tenant in config (all of config.json) by name, each with its own Calendar, and the RefreshPool they all share.
+
+    The default tenant keeps events.db, the others get events-<name>.db unless their config gives a store. Tenants using the same
+    service account file share a quota, since google counts it for the whole account.
+    """
+    def __init__(self, config, link_factory=None):
+        self.config = config
+
+        self.pool = RefreshPool(config.get("refresh_workers", 4))
+        self.fetch_pool = ThreadPoolExecutor(max_workers=config.get("fetch_workers", 8), thread_name_prefix="fetch")
+        self.mutation_pool = ThreadPoolExecutor(max_workers=config.get("mutation_workers", 8), thread_name_prefix="mutation")
+        self.optimise_pool = None # only started if a tenant has optimise on
+        self.notifier = Notifier(workers=config.get("notify_workers", 2)) # every tenant gets a channel of its own on it, with its own retries
+
+        self.quotas = {} # service account file name: TokenBucket
+        self.tenants = {}
+
+        for name, tenant_config in tenant_configs(config).items():
+            settings = Settings(tenant_config)
+
+            if name == default_tenant:
+                store = TaskStore() # picks up events.json the first time it runs
+            else:
+                store = TaskStore(tenant_config.get("store", f"events-{name}.db"), legacy_path=None)
+
+            quota = self.quotas.get(settings.service_account_file_name)
+            if quota is None:
+                quota = self.quotas[settings.service_account_file_name] = TokenBucket(settings.api_rate, settings.api_burst)
+
+            # doesn't talk to google, the first reload happens on the pool
+            calendar = Calendar(parse_time(tenant_config["log_on"]), parse_time(tenant_config["log_off"]), link_factory=link_factory,
+                settings=settings, store=store, quota=quota, fetch_pool=self.fetch_pool, mutation_pool=self.mutation_pool,
+                notifier=self.notifier)
+
+            if settings.optimise:
+                calendar.optimise_pool = self.get_optimise_pool()
+
+            self.tenants[name] = Tenant(name, tenant_config, calendar)
+
+    def get_optimise_pool(self):
+        if self.optimise_pool is None:
+            self.optimise_pool = optimiser.process_pool(self.config.get("optimise_workers", 2))
+
+        return self.optimise_pool
+
+    def get(self, name):
+        """
+        The tenant called name, or None if there isn't one.
+        """
+        return self.tenants.get(name)
+
+    def start(self):
+        for tenant in self.tenants.values():
+            self.pool.add(tenant)
+
+        self.pool.start()
+
+    def wake(self, tenant):
+        self.pool.wake(tenant)
+
+    def close(self):
+        self.pool.close()
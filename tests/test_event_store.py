@@ -0,0 +1,65 @@
+from datetime import datetime, timedelta
+
+from gcsa.event import Event
+
+from classes import EventStore, local_timezone, to_minutes
+from fake_calendar import FakeGoogleCalendar
+
+now = datetime.now(local_timezone).replace(second=0, microsecond=0)
+horizon = now + timedelta(days=30)
+
+def event(event_id, hours, length=1):
+    start = now + timedelta(hours=hours)
+    return Event(event_id, start=start, end=start + timedelta(hours=length), event_id=event_id)
+
+def minutes(hours, length=1):
+    start = now + timedelta(hours=hours)
+    return (to_minutes(start), to_minutes(start + timedelta(hours=length), up=True))
+
+def test_sync():
+    fake = FakeGoogleCalendar("read@fake", events=[event("a", 1), event("b", 3), event("c", 5)])
+    store = EventStore("read@fake", fake)
+
+    # the first sync downloads everything
+    assert store.sync(horizon) is True
+    assert fake.calls["list"] == 1
+    assert store.upcoming() == [minutes(1), minutes(3), minutes(5)]
+
+    # after that only the changes come back: an insert, an update and a cancellation
+    fake.put(event("d", 7))
+    fake.put(event("a", 2, length=2))
+    fake.remove("b")
+
+    assert store.sync(horizon) is True
+    assert fake.calls["list"] == 2
+    assert store.upcoming() == [minutes(2, length=2), minutes(5), minutes(7)]
+
+    # nothing changed
+    assert store.sync(horizon) is False
+    assert fake.calls["list"] == 3
+
+    # an expired token gets a 410, and everything is downloaded again
+    fake.remove("c")
+    fake.expire_tokens()
+
+    assert store.sync(horizon) is True
+    assert fake.calls["list"] == 5
+    assert store.upcoming() == [minutes(2, length=2), minutes(7)]
+
+    # and incremental syncs carry on from the new token
+    assert store.sync(horizon) is False
+    assert fake.calls["list"] == 6
+
+def test_skips_free_and_managed_events():
+    free = event("free", 1)
+    free.transparency = "transparent"
+
+    managed = event("managed", 2)
+    managed.description = "a task#auto"
+
+    fake = FakeGoogleCalendar("read@fake", events=[free, managed, event("busy", 3)])
+    store = EventStore("read@fake", fake)
+
+    store.sync(horizon)
+
+    assert store.upcoming() == [minutes(3)]
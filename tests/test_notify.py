@@ -0,0 +1,45 @@
+import threading
+import time
+
+from notify import MemorySink, Notifier
+
+class DownSink:
+    """
+    An endpoint which is down: every send fails, after hanging until released.
+    """
+    def __init__(self):
+        self.released = threading.Event()
+        self.tries = 0
+
+    def send(self, content):
+        self.tries += 1
+        self.released.wait()
+        raise ConnectionError("down")
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+def test_failing_channel_doesnt_hold_up_the_others():
+    notifier = Notifier(backoff=0.01)
+
+    down = DownSink()
+    failing = notifier.channel(down, retries=2)
+    working = notifier.channel(MemorySink())
+
+    failing.notify("a", "warning")
+    wait_for(lambda: down.tries == 1)
+
+    # one thread is stuck on the failing send, the other one is still free
+    working.notify("b", "warning")
+    wait_for(lambda: working.sink.messages == ["warning"])
+
+    # the failing send is tried again once its backoff is up, with the channel's own retries
+    down.released.set()
+    wait_for(lambda: down.tries == 3)
+
+    time.sleep(0.1)
+    assert down.tries == 3
@@ -0,0 +1,86 @@
+import random
+from datetime import datetime, time, timedelta
+
+import pytest
+
+from classes import Calendar, Settings, Task, local_timezone, task_of
+from notify import MemorySink
+from scheduling import IntervalIndex, to_minutes
+from store import TaskStore
+
+def no_google(calendar_id):
+    raise AssertionError("planning shouldn't talk to google")
+
+def make_calendar(path):
+    settings = Settings({"write_calendar": "write@fake", "service_account_file_name": "", "notify_run_url": ""})
+    store = TaskStore(str(path / "events.db"), legacy_path=None)
+
+    return Calendar(time(8), time(22), notify_run_client=MemorySink(), link_factory=no_google, settings=settings, store=store)
+
+def layout(task_list):
+    return [(start, task_of(item).uid, item.length) for start, item in task_list]
+
+@pytest.mark.parametrize("seed", [1, 2, 3])
+def test_incremental_plan_matches_planning_from_scratch(tmp_path, seed):
+    """
+    organise_calendar keeps the front of the last plan where nothing changed. After every random change to the tasks, the busy time
+    or when the plan starts, what it gives has to be the same as a dry run, which always plans from scratch.
+    """
+    rng = random.Random(seed)
+    calendar = make_calendar(tmp_path)
+
+    now = datetime.now(local_timezone).replace(minute=0, second=0, microsecond=0) + timedelta(hours=1)
+    start = now
+
+    def random_moment():
+        return now + timedelta(minutes=15 * rng.randrange(4 * 24 * 10))
+
+    def random_task(name):
+        due = now + timedelta(hours=rng.randrange(1, 300)) if rng.random() < 0.7 else None
+        return Task(name, minutes=rng.choice([15, 30, 60, 90, 180, 240]), due=due, split=rng.random() < 0.3, min_segment=rng.choice([15, 30, 60]))
+
+    intervals = []
+    for _ in range(150):
+        moment = random_moment()
+        intervals.append((to_minutes(moment), to_minutes(moment) + rng.choice([30, 60, 90])))
+
+    calendar.busy = IntervalIndex(intervals)
+    calendar.tasks_by_due.extend(random_task(f"t{i}") for i in range(150))
+
+    reused = 0
+
+    for step in range(150):
+        change = rng.random()
+
+        if change < 0.2:
+            calendar.tasks_by_due.insert(random_task(f"n{step}"))
+        elif change < 0.35:
+            calendar.tasks_by_due.discard(rng.choice(calendar.tasks_by_due.snapshot()))
+        elif change < 0.5:
+            moment = random_moment()
+            intervals.append((to_minutes(moment), to_minutes(moment) + 60))
+            calendar.busy = IntervalIndex(intervals)
+        elif change < 0.6:
+            intervals.pop(rng.randrange(len(intervals)))
+            calendar.busy = IntervalIndex(intervals)
+        elif change < 0.7:
+            start += timedelta(minutes=15)
+        elif change < 0.75:
+            rng.choice(calendar.tasks_by_due.snapshot()).length += timedelta(minutes=15)
+        elif change < 0.8:
+            start += timedelta(minutes=7) # off the grid, nothing can be kept
+
+        skipped_task = skipped_length = None
+        if rng.random() < 0.2:
+            skipped_task, skipped_length = rng.choice(calendar.tasks_by_due.snapshot()), timedelta(minutes=15)
+
+        incremental = calendar.organise_calendar(start, skipped_task, skipped_length)
+        reused += calendar.metrics.gauges["plan_reused_tasks"][()]
+
+        scratch = calendar.organise_calendar(start, skipped_task, skipped_length, tasks=calendar.tasks_by_due.snapshot(), dry_run=True)
+
+        assert layout(incremental) == layout(scratch), f"step {step}"
+
+    assert reused > 0 # otherwise this only compared two plans from scratch
+
+    calendar.store.close()
@@ -0,0 +1,132 @@
+import json
+
+from datetime import time, timedelta
+
+from gcsa.event import Event
+
+from classes import Calendar, GCColour, Settings, Task, tag
+from fake_calendar import FakeGoogleCalendar
+from notify import MemorySink
+from store import TaskStore
+
+def make_calendar(path, fakes):
+    settings = Settings({"write_calendar": "write@fake", "read_calendars": ["read@fake"], "service_account_file_name": "", "notify_run_url": "",
+        "api_cache_ttl": 0}) # the fakes are changed behind the cache's back
+    store = TaskStore(str(path / "events.db"), legacy_path=None)
+
+    # active all day, so only the busy event decides where tasks go
+    return Calendar(time(0), time(0), notify_run_client=MemorySink(), link_factory=lambda calendar_id: fakes[calendar_id], settings=settings, store=store)
+
+def setup(path):
+    fakes = {"write@fake": FakeGoogleCalendar("write@fake"), "read@fake": FakeGoogleCalendar("read@fake")}
+    calendar = make_calendar(path, fakes)
+
+    # a 180 minute split task only has 150 minutes before the busy event, so it goes up as two segments
+    start = calendar.working_start()
+    fakes["read@fake"].put(Event("busy", start=start + timedelta(minutes=150), end=start + timedelta(minutes=240), event_id="busy"))
+
+    task = Task("essay", minutes=180, split=True, min_segment=15)
+    calendar.add_tasks([task])
+
+    return fakes, calendar, task
+
+def planned_minutes(fake):
+    return sorted((event.end - event.start) // timedelta(minutes=1) for event in fake.events.values())
+
+def test_failed_segment_is_planned_again(tmp_path):
+    fakes, calendar, task = setup(tmp_path)
+    write = fakes["write@fake"]
+
+    # one of the two creates is turned away
+    add_event = write.add_event
+
+    def add_event_once(event, **kwargs):
+        del write.add_event
+        write.fail_next(400)
+        return add_event(event, **kwargs)
+
+    write.add_event = add_event_once
+    calendar.reload_tasks()
+
+    assert len(write.events) == 1
+
+    # the one which went through doesn't make the task any shorter, and the rest of it is put back on the next reload
+    calendar.reload_tasks()
+
+    assert task.length == timedelta(minutes=180)
+    assert sum(planned_minutes(write)) == 180
+
+    calendar.reload_tasks()
+
+    assert task.length == timedelta(minutes=180)
+    assert len(write.events) == 2
+
+    calendar.store.close()
+
+def test_segment_edits(tmp_path):
+    fakes, calendar, task = setup(tmp_path)
+    write = fakes["write@fake"]
+
+    calendar.reload_tasks()
+    assert planned_minutes(write) == [30, 150]
+
+    # the user makes the short segment 15 minutes longer, which makes the task 15 minutes longer
+    short = min(write.events.values(), key=lambda event: event.end - event.start)
+    short.end += timedelta(minutes=15)
+    write.put(short)
+
+    calendar.reload_tasks()
+    assert task.length == timedelta(minutes=195)
+
+    # and marks the long one as done, which only takes that segment off
+    long = max(write.events.values(), key=lambda event: event.end - event.start)
+    long.color_id = GCColour.BASIL.value
+    write.put(long)
+
+    calendar.reload_tasks()
+    assert task.length == timedelta(minutes=45)
+
+    calendar.store.close()
+
+def test_cleared_description(tmp_path):
+    fakes, calendar, task = setup(tmp_path)
+    write = fakes["write@fake"]
+
+    calendar.reload_tasks()
+
+    # with its description gone an event is only found by its id, and comes back without one
+    for event in list(write.events.values()):
+        event.description = None
+        write.put(event)
+
+    calendar.reload_tasks()
+    calendar.reload_tasks()
+
+    assert task.desc == ""
+    assert all(event.description == tag for event in write.events.values())
+
+    calendar.store.close()
+
+def test_task_longer_than_a_day_is_reported(tmp_path):
+    fakes = {"write@fake": FakeGoogleCalendar("write@fake"), "read@fake": FakeGoogleCalendar("read@fake")}
+    calendar = make_calendar(tmp_path, fakes)
+    calendar.log_on, calendar.log_off = time(22), time(2)
+
+    # 600 minutes can't go anywhere in a 4 hour day without being split
+    task = Task("marathon", minutes=600, due=calendar.working_start() + timedelta(days=3))
+
+    preview = calendar.preview([task])
+    assert preview["tasks"] == [] and preview["late"] == []
+    assert preview["infeasible"] == [task.uid]
+    assert preview["unplaced"] == [task.uid]
+
+    calendar.add_tasks([task])
+    calendar.reload_tasks()
+
+    schedule = json.loads(calendar.schedule()[0])
+    assert schedule["infeasible"] == [task.uid]
+    assert schedule["unplaced"] == [task.uid]
+    assert calendar.metrics.gauges["unplaced_tasks"][()] == 1
+    assert calendar.metrics.gauges["infeasible_tasks"][()] == 1
+
+    calendar.store.close()